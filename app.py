@@ -1,6 +1,8 @@
 import dash
 from dash import Dash, dcc, html, Input, Output, callback
 import page_mcap, page_price
+from flask import Response
+from metrics import latency_metrics
 
 
 app = Dash(__name__, suppress_callback_exceptions=True)
@@ -12,6 +14,12 @@ app.layout = html.Div([
 ])
 
 
+@server.route('/metrics')
+def serve_metrics():
+    # callback latencies of this server process, in Prometheus text format
+    return Response(latency_metrics.render(), mimetype='text/plain')
+
+
 @callback(Output('page-content', 'children'),
               Input('url', 'pathname'))
 def display_page(pathname):
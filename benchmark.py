@@ -0,0 +1,162 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+
+import numpy as np
+
+import jit_kernels
+import utils as ut
+from liquidity_pool import LiquidityPool
+from pool_pair_price import compute_market_cap_saved, final_price_if_all_uniswap
+from simulation import perform_simulation
+
+IMBALANCE_RATIOS = [1, 2, 10, 100]
+AMPLIFICATIONS = [0.0001, 1, 85, 200]
+POOL_AMPLIFICATIONS = {'uniswap': 0.00001, 'stableswap': 85, 'customswap': [85, 0.0001]}
+MARKET_CAP_POOL_SIZES = [100000, 1000000]
+MARKET_CAP_SELL_RATIOS = [0.1, 1]
+MAX_JIT_DIFFERENCE = 1e-12  # largest allowed relative difference between the JIT kernels and the Python code
+
+
+def time_function(function, repeat=5, number=None):
+    """
+    Time a function with timeit, taking the best of several repeats.
+    :param function: function without arguments
+    :param repeat: number of repeats
+    :param number: calls per repeat, by default chosen so that a repeat takes at least 0.2 seconds
+    :return: best time per call in seconds
+    """
+    timer = timeit.Timer(function)
+    if number is None:
+        number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def _pool_benchmarks(pricing_method):
+    def exchange():
+        lp = LiquidityPool(['Boot', 'USDC'], [50000, 50000], fee_ratio=0, pricing_method=pricing_method,
+                           amplification=POOL_AMPLIFICATIONS[pricing_method], promoted_token_label='Boot')
+        for _ in range(10):
+            lp.exchange('Boot', 'USDC', 5000)
+
+    def get_price():
+        lp = LiquidityPool(['Boot', 'USDC'], [30000, 70000], fee_ratio=0, pricing_method=pricing_method,
+                           amplification=POOL_AMPLIFICATIONS[pricing_method], promoted_token_label='Boot')
+        for _ in range(10):
+            lp.get_price('USDC', 'Boot')
+
+    return {'pool.exchange[%s]' % pricing_method: exchange, 'pool.get_price[%s]' % pricing_method: get_price}
+
+
+def _market_cap_benchmark(boot_pool_token_num, large_sell_ratio):
+    def market_cap():
+        # the memoized baseline is part of what is measured
+        final_price_if_all_uniswap.cache_clear()
+        compute_market_cap_saved(1000000, large_sell_ratio=large_sell_ratio, boot_pool_token_num=boot_pool_token_num,
+                                 amplification=[85, 0.0001])
+
+    return market_cap
+
+
+def get_benchmarks():
+    # name -> function without arguments
+    benchmarks = {}
+
+    for imbalance_ratio in IMBALANCE_RATIOS:
+        x = [50000, 50000 * imbalance_ratio]
+        for amplification in AMPLIFICATIONS:
+            benchmarks['curve_get_D[ratio=%g,A=%g]' % (imbalance_ratio, amplification)] = \
+                lambda x=x, amplification=amplification: ut.curve_get_D(x, amplification)
+            benchmarks['curve_get_y[ratio=%g,A=%g]' % (imbalance_ratio, amplification)] = \
+                lambda x=x, amplification=amplification: ut.curve_get_y(0, 1, x[0] + 5000, x, amplification)
+
+    for pricing_method in POOL_AMPLIFICATIONS:
+        benchmarks.update(_pool_benchmarks(pricing_method))
+
+    benchmarks['perform_simulation'] = perform_simulation
+
+    for boot_pool_token_num in MARKET_CAP_POOL_SIZES:
+        for large_sell_ratio in MARKET_CAP_SELL_RATIOS:
+            benchmarks['compute_market_cap_saved[pool=%d,sell=%g]' % (boot_pool_token_num, large_sell_ratio)] = \
+                _market_cap_benchmark(boot_pool_token_num, large_sell_ratio)
+
+    return benchmarks
+
+
+def run_benchmarks(repeat=5, name_filter=None):
+    """
+    Run the benchmarks.
+    :param repeat: number of timing repeats per benchmark
+    :param name_filter: only run benchmarks whose name contains this string
+    :return: dictionary of benchmark name -> best time per call in seconds
+    """
+    results = {}
+    for name, function in get_benchmarks().items():
+        if name_filter is not None and name_filter not in name:
+            continue
+        results[name] = time_function(function, repeat=repeat)
+        print('%-50s %12.3f ms' % (name, results[name] * 1000))
+    return results
+
+
+def find_regressions(results, baseline_results, max_slowdown=1.25):
+    """
+    Compare benchmark results with a baseline run.
+    :param results: dictionary of benchmark name -> time
+    :param baseline_results: dictionary of benchmark name -> time of the baseline run
+    :param max_slowdown: allowed ratio of time to baseline time
+    :return: dictionary of benchmark name -> slowdown ratio, for benchmarks slower than allowed
+    """
+    regressions = {}
+    for name, seconds in results.items():
+        if name in baseline_results and seconds > max_slowdown * baseline_results[name]:
+            regressions[name] = seconds / baseline_results[name]
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the curve math, pools and dashboard pipelines.')
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON file of a baseline run to compare the results with, also checks that the JIT '
+                                          'kernels match the Python code')
+    parser.add_argument('--max-slowdown', type=float, default=1.25,
+                        help='fail if a benchmark is this many times slower than in the baseline run')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timing repeats per benchmark')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this string')
+    args = parser.parse_args()
+
+    results = run_benchmarks(repeat=args.repeat, name_filter=args.filter)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'timestamp': time.time(), 'python': platform.python_version(), 'numpy': np.__version__,
+                       'machine': platform.machine(), 'jit': jit_kernels.enabled, 'benchmarks': results}, f,
+                      indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline_results = json.load(f)['benchmarks']
+        regressions = find_regressions(results, baseline_results, max_slowdown=args.max_slowdown)
+        for name, slowdown in regressions.items():
+            print('REGRESSION %s: %.2fx slower than baseline' % (name, slowdown))
+
+        # a faster kernel is only an improvement if it still computes the same numbers as the Python code
+        jit_difference = None
+        if jit_kernels.numba is None:
+            print('numba is not installed, the JIT equivalence check is skipped')
+        else:
+            jit_difference = jit_kernels.check_equivalence()
+            print('largest relative difference between compiled and Python results: %g' % jit_difference)
+            if jit_difference >= MAX_JIT_DIFFERENCE:
+                print('JIT MISMATCH: compiled kernels differ from the Python code by more than %g'
+                      % MAX_JIT_DIFFERENCE)
+
+        if regressions or (jit_difference is not None and jit_difference >= MAX_JIT_DIFFERENCE):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import os
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# compiled versions of the curve solvers and of the customswap amplification switch, used by utils and LiquidityPool
+# when numba is installed. USE_JIT=0 falls back to the Python code. Compiled kernels are cached on disk next to this
+# file (or in NUMBA_CACHE_DIR), so server workers load them instead of compiling them on every boot.
+enabled = numba is not None and os.environ.get('USE_JIT', '1') != '0'
+
+
+def _jit(function):
+    return numba.njit(cache=True)(function) if numba is not None else function
+
+
+@_jit
+def _curve_get_D(x, A, precision):
+    # same iteration as utils.curve_get_D, returns D and the change of D in the last iteration
+    n_coins = x.shape[0]
+    S = 0.0
+    P = 1.0
+    for i in range(n_coins):
+        S += x[i]
+        P *= x[i]
+    G = n_coins * P ** (1 / n_coins)
+
+    D = S
+    Dprev = D
+    Ann = A * n_coins
+    for c in range(0, 254):
+        D_P = D * (D / G) ** float(n_coins)
+
+        Dprev = D
+        D = (Ann * S + D_P * n_coins) * D / ((Ann - 1) * D + (n_coins + 1) * D_P)
+        if D >= Dprev:
+            if D - Dprev <= precision:
+                break
+            elif Dprev - D <= precision:
+                break
+
+    return D, abs(D - Dprev)
+
+
+@_jit
+def _curve_get_y(payment_token_index, requested_token_index, token_amounts_after_payment,
+                 token_amounts_before_payment, amp, D, precision):
+    # same iteration as utils.curve_get_y
+    N_COINS = token_amounts_before_payment.shape[0]
+    Ann = amp * N_COINS
+
+    S_ = 0.0
+    P = 1.0
+    for i in range(N_COINS):
+        if i == requested_token_index:
+            continue
+        _x = token_amounts_after_payment if i == payment_token_index else token_amounts_before_payment[i]
+        S_ += _x
+        P *= _x
+    G = N_COINS * P ** (1 / (N_COINS - 1))
+    c = D * (D / G) ** float(N_COINS - 1)
+
+    c = c * D / (Ann * N_COINS)
+    b = S_ + D / Ann
+    y = D
+    for _i in range(0, 254):
+        y_prev = y
+        y = (y * y + c) / (2 * y + b - D)
+        if abs(y - y_prev) <= precision:
+            break
+    return y
+
+
+@_jit
+def _customswap_regime(token_amounts, promoted_token_index, non_promoted_token_indices, transition_ratio):
+    # 0 for the first amplification factor, 1 for the last, see LiquidityPool._get_customswap_amplification
+    non_promoted_token_amount = 0.0
+    for i in non_promoted_token_indices:
+        non_promoted_token_amount += token_amounts[i]
+    non_promoted_token_amount /= len(non_promoted_token_indices)
+
+    return 0 if token_amounts[promoted_token_index] / non_promoted_token_amount > transition_ratio else 1
+
+
+@_jit
+def _customswap_get_y(payment_token_index, requested_token_index, token_amounts_after_payment,
+                      token_amounts_before_payment, promoted_token_index, non_promoted_token_indices,
+                      amplifications, transition_ratio, Ds, D_precision, y_precision):
+    # the customswap branch of LiquidityPool.get_requested_token_amount_by_index. Ds holds D for each of the two
+    # amplification factors, NaN if unknown, and is filled in where D is solved for.
+    regime = _customswap_regime(token_amounts_before_payment, promoted_token_index, non_promoted_token_indices,
+                                transition_ratio)
+    if np.isnan(Ds[regime]):
+        Ds[regime] = _curve_get_D(token_amounts_before_payment, amplifications[regime], D_precision)[0]
+    y = _curve_get_y(payment_token_index, requested_token_index, token_amounts_after_payment,
+                     token_amounts_before_payment, amplifications[regime], Ds[regime], y_precision)
+
+    # check if the condition for choosing the amplification factor still exists
+    potential_token_amounts = token_amounts_before_payment.copy()
+    potential_token_amounts[payment_token_index] = token_amounts_after_payment
+    potential_token_amounts[requested_token_index] = y
+    last_regime = _customswap_regime(potential_token_amounts, promoted_token_index, non_promoted_token_indices,
+                                     transition_ratio)
+
+    if last_regime != regime:
+        if np.isnan(Ds[last_regime]):
+            Ds[last_regime] = _curve_get_D(token_amounts_before_payment, amplifications[last_regime], D_precision)[0]
+        y = _curve_get_y(payment_token_index, requested_token_index, token_amounts_after_payment,
+                         token_amounts_before_payment, amplifications[last_regime], Ds[last_regime], y_precision)
+
+    return y, last_regime
+
+
+def curve_get_D(x, A, precision):
+    """
+    Compiled utils.curve_get_D.
+    :return: D and the change of D in the last iteration
+    """
+    return _curve_get_D(np.asarray(x, dtype=np.float64), float(A), precision)
+
+
+def curve_get_y(payment_token_index, requested_token_index, token_amounts_after_payment,
+                token_amounts_before_payment, amp, D, precision):
+    # compiled utils.curve_get_y, D is required
+    return _curve_get_y(payment_token_index, requested_token_index, float(token_amounts_after_payment),
+                        np.asarray(token_amounts_before_payment, dtype=np.float64), float(amp), float(D), precision)
+
+
+def customswap_get_y(payment_token_index, requested_token_index, token_amounts_after_payment,
+                     token_amounts_before_payment, promoted_token_index, non_promoted_token_indices, amplifications,
+                     transition_ratio, Ds, D_precision, y_precision):
+    """
+    Compiled customswap swap: choose the amplification factor, solve for the requested token amount and switch the
+    amplification factor if the swap crosses the transition ratio.
+    :param amplifications: the first and last customswap amplification factors
+    :param Ds: array of D for each of the two amplification factors, NaN if unknown, filled in where solved for
+    :return: total amount of the requested token in the pool after payment, index of the amplification factor used
+    """
+    return _customswap_get_y(payment_token_index, requested_token_index, float(token_amounts_after_payment),
+                             token_amounts_before_payment, promoted_token_index, non_promoted_token_indices,
+                             np.asarray(amplifications, dtype=np.float64), float(transition_ratio), Ds, D_precision,
+                             y_precision)
+
+
+def check_equivalence(n_cases=200, n_coins=(2, 3, 4), seed=0):
+    """
+    Compare the compiled kernels with the Python code on random pools and trades.
+    :param n_cases: number of random cases per coin count
+    :param n_coins: coin counts to test
+    :param seed: random seed
+    :return: largest relative difference of D, y and the customswap swap results
+    """
+    import utils as ut
+    from liquidity_pool import LiquidityPool
+
+    global enabled
+    previous_enabled = enabled
+
+    rng = np.random.default_rng(seed)
+    max_difference = 0.0
+    try:
+        for n in n_coins:
+            for _ in range(n_cases):
+                x = rng.uniform(1e3, 1e6, n)
+                amp = 10 ** rng.uniform(-4, np.log10(200))
+                dx = rng.uniform(0, 2) * x[0]
+                labels = ['token%d' % i for i in range(n)]
+
+                results = []
+                for use_jit in (True, False):
+                    enabled = use_jit
+                    pool = LiquidityPool(labels, x, fee_ratio=0, pricing_method='customswap',
+                                         amplification=[amp, 0.0001], promoted_token_label=labels[0])
+                    received_amount = pool.exchange(labels[0], labels[1], dx)
+                    results.append([ut.curve_get_D(x, amp), ut.curve_get_y(0, 1, x[0] + dx, x, amp),
+                                    received_amount, pool.get_last_amplification(), pool.get_D()])
+
+                compiled, reference = np.array(results)
+                max_difference = max(max_difference, np.max(np.abs(compiled - reference) / np.abs(reference)))
+    finally:
+        enabled = previous_enabled
+
+    return max_difference
+
+
+if __name__ == '__main__':
+    if numba is None:
+        print('numba is not installed, the Python code is used')
+    else:
+        print('largest relative difference between compiled and Python results: %g' % check_equivalence())
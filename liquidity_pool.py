@@ -1,48 +1,122 @@
+import jit_kernels
 import utils as ut
 from typing import List, Union
 import numpy as np
+from copy import copy
 
-VERY_SMALL_AMOUNT = 1e-1
 UNISWAP_AMPLIFICATION = 0.00001
 
+# pricing methods are resolved to these ids once, when a pool is created
+UNISWAP = 0
+STABLESWAP = 1
+CUSTOMSWAP = 2
+PRICING_METHOD_IDS = {'uniswap': UNISWAP, 'stableswap': STABLESWAP, 'customswap': CUSTOMSWAP}
+
 
 class LiquidityPool:
     # A liquidity pool with one of several types of pricing strategy (UniSwap, StableSwap, CustomSwap)
 
+    __slots__ = ('token_labels', 'token_amount_scales', 'amplification_transition_ratio', '_token_amounts',
+                 '_token_initial_amounts', '_fee_ratio', '_pricing_method', '_pricing_method_id', '_amplification',
+                 '_last_amplification', '_promoted_token_label', '_promoted_token_index',
+                 '_non_promoted_token_indices', '_token_id', '_D_by_amplification')
+
     def __init__(self, token_labels: List[str], token_initial_amounts: List[float], fee_ratio: float,
                  pricing_method: str, amplification: Union[float, List[float]] = UNISWAP_AMPLIFICATION,
                  promoted_token_label: str = None):
         """
 
         :param token_labels: list of strings indicating token names, e.g. ETH, USDC
-        :param token_initial_amounts: amounts of tokens, same order as labels, e.g. 10.5 ETH, 1000 UDSC
+        :param token_initial_amounts: amounts of tokens, same order as labels, e.g. 10.5 ETH, 1000 UDSC. The pool
+                                      keeps its own float64 copy of them.
         :param fee_ratio: fee ratio, e.g. 0.03
         :param pricing_method: type of method used for pool pricing. One of {'uniswap', 'stableswap', 'customswap'}
         :param amplification: amplification factor(s) used in 'stableswap' and 'customswap' methods. For
                               'stableswap' this would be a single number. For 'customswap' this shodul be a list of
-                              two numbers.
+                              two numbers, the first used while the promoted token amount is more than
+                              amplification_transition_ratio times the mean amount of the other tokens.
+                              Stableswap and customswap pools can have any number of tokens.
         :param promoted_token_label: token label for which customswap reduces initial price decrease.
         :param target_price used in 'customswap' method.
         """
+        if pricing_method not in PRICING_METHOD_IDS:
+            raise ValueError('pricing_method not recognized')
+
         self.token_labels = token_labels
 
-        self._token_amounts = token_initial_amounts
+        self._token_amounts = np.array(token_initial_amounts, dtype=np.float64)
         self._fee_ratio = fee_ratio
         self._pricing_method = pricing_method
+        self._pricing_method_id = PRICING_METHOD_IDS[pricing_method]
         self._amplification = amplification
         self.amplification_transition_ratio = 1  # ratio of tokens at which A switches
-        self._last_amplification = None  # the
-        self._promoted_token_label = promoted_token_label# amplification factor used to calculate the last price
+        self._last_amplification = None  # amplification factor used to calculate the last price
+        self._promoted_token_label = promoted_token_label
 
         # maps token labels to integer ids
         self._token_id = {}
         for i, label in enumerate(token_labels):
             self._token_id[label] = i
 
+        if self._pricing_method_id == CUSTOMSWAP:
+            self._promoted_token_index = self._token_id[promoted_token_label]
+            self._non_promoted_token_indices = tuple(i for i in range(len(token_labels))
+                                                     if i != self._promoted_token_index)
+        else:
+            self._promoted_token_index = None
+            self._non_promoted_token_indices = None
+
         # normalize token amounts at formation to both be 1
-        self.token_amount_scales = token_initial_amounts
+        self.token_amount_scales = self._token_amounts.copy()
         self._token_initial_amounts = np.ones(len(token_initial_amounts))
 
+        # invariant D of the current token amounts for each amplification factor used so far. Swaps without fee keep
+        # D unchanged for the amplification factor used in the swap, so it is carried across trades.
+        self._D_by_amplification = {}
+
+    def _get_D(self, amplification):
+        """
+        Get the invariant D of the current token amounts, solving for it only if it is not already known.
+        :param amplification: amplification factor used to compute D
+        :return: quantity D as noted in the StableSwap white paper
+        """
+        D = self._D_by_amplification.get(amplification)
+        if D is None:
+            if self._pricing_method_id == UNISWAP:
+                D = ut.uniswap_get_D(self._token_amounts)
+            else:
+                D = ut.curve_get_D(self._token_amounts, amplification)
+            self._D_by_amplification[amplification] = D
+        return D
+
+    def _get_customswap_amplification(self, token_amounts):
+        """
+        Choose the customswap amplification factor for the given token amounts. The promoted token amount is compared
+        with the mean amount of the other tokens, which for two tokens is simply the other token amount.
+        :param token_amounts: amounts of tokens in the pool
+        :return: the amplification factor
+        """
+        non_promoted_token_amount = sum(token_amounts[i] for i in self._non_promoted_token_indices) \
+            / len(self._non_promoted_token_indices)
+
+        if token_amounts[self._promoted_token_index] / non_promoted_token_amount > \
+                self.amplification_transition_ratio:
+            # when too much of the promoted token is available,
+            # (slow price decrease, high amplification, more like StableSwap)
+            return self._amplification[0]
+        else:
+            # when less of the promoted token is available, use UniSwap like curve
+            # (faster price increase, low amplification)
+            return self._amplification[-1]
+
+    def get_token_index(self, token_label):
+        """
+        Get the index of a token, for use with the *_by_index methods.
+        :param token_label: token label
+        :return: index of the token in the pool
+        """
+        return self._token_id[token_label]
+
     def get_requested_token_amount(self, payment_token_label, requested_token_label, payment_token_amount,
                                    fee_ratio):
         """
@@ -53,21 +127,37 @@ class LiquidityPool:
         :param fee_ratio: fee ratio, e.g. 0.03
         :return: the amount of requested token provided to the user (swapped with payment token)
         """
+        return self.get_requested_token_amount_by_index(self._token_id[payment_token_label],
+                                                        self._token_id[requested_token_label],
+                                                        payment_token_amount, fee_ratio)
 
-        payment_token_index = self._token_id[payment_token_label]
-        requested_token_index = self._token_id[requested_token_label]
+    def get_requested_token_amount_by_index(self, payment_token_index, requested_token_index, payment_token_amount,
+                                            fee_ratio):
+        """
+        Same as get_requested_token_amount, with tokens given by their index.
+        """
 
-        if self._pricing_method == 'stableswap':
+        solver_telemetry = ut.get_solver_telemetry()
+        if solver_telemetry is not None:
+            solver_telemetry.pricing_method = self._pricing_method
+
+        if self._pricing_method_id == STABLESWAP:
             self._last_amplification = self._amplification
             requested_token_amount_afterwards = ut.curve_get_y(payment_token_index, requested_token_index,
                                                     self._token_amounts[payment_token_index] + payment_token_amount,
-                                                    self._token_amounts, self._last_amplification)
-        elif self._pricing_method == 'uniswap':
+                                                    self._token_amounts, self._last_amplification,
+                                                    D=self._get_D(self._last_amplification))
+        elif self._pricing_method_id == UNISWAP:
+            # constant product pool, solved in closed form. UNISWAP_AMPLIFICATION is only kept as the reported A.
             self._last_amplification = UNISWAP_AMPLIFICATION
-            requested_token_amount_afterwards = ut.curve_get_y(payment_token_index, requested_token_index,
+            requested_token_amount_afterwards = ut.uniswap_get_y(payment_token_index, requested_token_index,
                                                     self._token_amounts[payment_token_index] + payment_token_amount,
-                                                    self._token_amounts, self._last_amplification)
-        elif self._pricing_method == 'customswap':
+                                                    self._token_amounts)
+        elif self._pricing_method_id == CUSTOMSWAP and jit_kernels.enabled and solver_telemetry is None:
+            requested_token_amount_afterwards = self._customswap_get_y_compiled(payment_token_index,
+                                                                                requested_token_index,
+                                                                                payment_token_amount)
+        elif self._pricing_method_id == CUSTOMSWAP:
 
             # - Determine the correct A by comparing xp[0] and xp[1].
             # - Calculate starting D.
@@ -76,38 +166,24 @@ class LiquidityPool:
             # - Compare xp2[0] and xp2[1] and determine the target A
             # - If A changed, calculate y again given A' and D
 
-            promoted_token_index = self._token_id[self._promoted_token_label]
-            non_promoted_token_index = list((set([0, 1]) - set([promoted_token_index])))[0]
-
-            if self._token_amounts[promoted_token_index] / self._token_amounts[non_promoted_token_index] > \
-                    self.amplification_transition_ratio:
-                # when too much of the promoted token is available,
-                # (slow price decrease, high amplification, more like StableSwap)
-                potential_amplification = self._amplification[0]
-            else:
-                # when less of the promoted token is available, use UniSwap like curve
-                # (faster price increase, low amplification)
-                potential_amplification = self._amplification[1]
+            potential_amplification = self._get_customswap_amplification(self._token_amounts)
 
             requested_token_amount = ut.curve_get_y(payment_token_index, requested_token_index,
                         self._token_amounts[payment_token_index] + payment_token_amount,
-                        self._token_amounts, potential_amplification)
+                        self._token_amounts, potential_amplification, D=self._get_D(potential_amplification))
 
             # check if the condition for choosing the amplification factor still exists
             potential_token_amounts = self._token_amounts.copy()
             potential_token_amounts[payment_token_index] += payment_token_amount
             potential_token_amounts[requested_token_index] = requested_token_amount
 
-            if potential_token_amounts[promoted_token_index] / potential_token_amounts[non_promoted_token_index] > \
-                    self.amplification_transition_ratio:
-                self._last_amplification = self._amplification[0]
-            else:
-                self._last_amplification = self._amplification[-1]
+            self._last_amplification = self._get_customswap_amplification(potential_token_amounts)
 
             if self._last_amplification != potential_amplification:
                 requested_token_amount_afterwards = ut.curve_get_y(payment_token_index, requested_token_index,
                                                                    self._token_amounts[payment_token_index] + payment_token_amount,
-                                                                   self._token_amounts, self._last_amplification)
+                                                                   self._token_amounts, self._last_amplification,
+                                                                   D=self._get_D(self._last_amplification))
             else:
                 requested_token_amount_afterwards = potential_token_amounts[requested_token_index]
         else:
@@ -118,22 +194,106 @@ class LiquidityPool:
         returned_token_amount = returned_token_amount - fee
         return returned_token_amount
 
+    def _customswap_get_y_compiled(self, payment_token_index, requested_token_index, payment_token_amount):
+        # the customswap branch of get_requested_token_amount_by_index as a single compiled kernel
+        amplifications = (self._amplification[0], self._amplification[-1])
+        Ds = np.array([self._D_by_amplification.get(amplification, np.nan) for amplification in amplifications])
+
+        requested_token_amount_afterwards, regime = jit_kernels.customswap_get_y(
+            payment_token_index, requested_token_index, self._token_amounts[payment_token_index] + payment_token_amount,
+            self._token_amounts, self._promoted_token_index, self._non_promoted_token_indices, amplifications,
+            self.amplification_transition_ratio, Ds, ut.D_EQUALITY_PRECISION, ut.Y_EQUALITY_PRECISION)
+
+        for amplification, D in zip(amplifications, Ds):
+            if not np.isnan(D):
+                self._D_by_amplification[amplification] = D
+        self._last_amplification = amplifications[regime]
+        return requested_token_amount_afterwards
+
     def get_last_amplification(self):
         return self._last_amplification
 
-    def get_price(self, payment_token_label, requested_token_label, payment_token_amount=VERY_SMALL_AMOUNT):
+    def get_fee_ratio(self):
+        return self._fee_ratio
+
+    def get_pricing_method(self):
+        return self._pricing_method
+
+    def get_amplification(self):
+        # amplification factor(s) the pool was created with
+        return self._amplification
+
+    def get_promoted_token_index(self):
+        # index of the customswap promoted token, None for other pricing methods
+        return self._promoted_token_index
+
+    def get_token_amounts(self):
+        # copy of the current amounts of tokens in the pool
+        return self._token_amounts.copy()
+
+    def snapshot(self):
+        """
+        Capture the mutable state of the pool (token amounts, last amplification factor and known D values), e.g. to
+        try a trade and then revert it.
+        :return: the state, to be passed to restore()
+        """
+        return self._token_amounts.copy(), self._last_amplification, dict(self._D_by_amplification)
+
+    def restore(self, state):
         """
-        Compute token price for payment of a very small amount of the payment token.
+        Restore a state captured by snapshot(). A state can be restored any number of times.
+        :param state: state returned by snapshot()
+        """
+        token_amounts, self._last_amplification, D_by_amplification = state
+        self._token_amounts = token_amounts.copy()
+        self._D_by_amplification = dict(D_by_amplification)
+
+    def clone(self):
+        """
+        Copy the pool. Only the mutable state is copied, configuration such as labels and amplification factors is
+        shared with the original pool.
+        :return: the copy
+        """
+        pool = copy(self)
+        pool.restore(self.snapshot())
+        return pool
+
+    def get_price(self, payment_token_label, requested_token_label, payment_token_amount=None):
+        """
+        Compute token price. By default this is the marginal (spot) price at the current token amounts, computed
+        analytically from the pool invariant. If a payment token amount is given, the price of a trade of that
+        size is computed instead.
         :param payment_token_label: payment token label
         :param requested_token_label: requested token label
-        :param payment_token_amount: payment token amount
-        :return: the price, as how much of requested token will be provided for per unit of payment token.
+        :param payment_token_amount: optional payment token amount
+        :return: the price, as how much of payment token is needed per unit of requested token.
         """
 
-        price = payment_token_amount / self.get_requested_token_amount(payment_token_label, requested_token_label, payment_token_amount,
-                                                fee_ratio=0)
+        if payment_token_amount is not None:
+            return payment_token_amount / self.get_requested_token_amount(payment_token_label, requested_token_label,
+                                                                          payment_token_amount, fee_ratio=0)
+
+        return self.get_price_by_index(self._token_id[payment_token_label], self._token_id[requested_token_label])
 
-        return price
+    def get_price_by_index(self, payment_token_index, requested_token_index):
+        """
+        Same as get_price for the marginal (spot) price, with tokens given by their index.
+        """
+
+        solver_telemetry = ut.get_solver_telemetry()
+        if solver_telemetry is not None:
+            solver_telemetry.pricing_method = self._pricing_method
+
+        if self._pricing_method_id == UNISWAP:
+            self._last_amplification = UNISWAP_AMPLIFICATION
+            return ut.uniswap_get_spot_price(payment_token_index, requested_token_index, self._token_amounts)
+        elif self._pricing_method_id == STABLESWAP:
+            self._last_amplification = self._amplification
+        else:
+            self._last_amplification = self._get_customswap_amplification(self._token_amounts)
+
+        return ut.curve_get_spot_price(payment_token_index, requested_token_index, self._token_amounts,
+                                       self._last_amplification, D=self._get_D(self._last_amplification))
 
     def exchange(self, payment_token_label, requested_token_label, payment_token_amount):
         """
@@ -144,20 +304,76 @@ class LiquidityPool:
         :return: the amount of requested token sent back to the user.
         """
 
-        returned_token_amount = self.get_requested_token_amount(payment_token_label, requested_token_label,
-                                                                payment_token_amount, fee_ratio=self._fee_ratio)
+        return self.exchange_by_index(self._token_id[payment_token_label], self._token_id[requested_token_label],
+                                      payment_token_amount)
 
-        payment_token_index = self._token_id[payment_token_label]
-        requested_token_index = self._token_id[requested_token_label]
+    def exchange_by_index(self, payment_token_index, requested_token_index, payment_token_amount):
+        """
+        Same as exchange, with tokens given by their index.
+        """
+
+        returned_token_amount = self.get_requested_token_amount_by_index(payment_token_index, requested_token_index,
+                                                                         payment_token_amount,
+                                                                         fee_ratio=self._fee_ratio)
 
         self._token_amounts[payment_token_index] += payment_token_amount
         self._token_amounts[requested_token_index] -= returned_token_amount
 
+        # without fee D is unchanged for the amplification used in the swap, other D values are now stale
+        if self._fee_ratio == 0 and self._last_amplification in self._D_by_amplification:
+            self._D_by_amplification = {self._last_amplification: self._D_by_amplification[self._last_amplification]}
+        else:
+            self._D_by_amplification = {}
+
         return returned_token_amount
 
+    def simulate_path(self, payment_token_label, requested_token_label, payment_token_amounts,
+                      reverse_slippage=False):
+        """
+        Execute a sequence of swaps of payment token for requested token, recording the pool state after each swap.
+        The spot price after a swap is reused as the price before the next one.
+        :param payment_token_label: payment token label
+        :param requested_token_label: requested token label
+        :param payment_token_amounts: array of payment token amounts, one per swap
+        :param reverse_slippage: compute slippage of 1/price
+        :return: structured array with one record per swap and fields 'received_amount', 'price' (spot price after
+                 the swap), 'slippage' (see get_price_slippage), 'D', 'amplification' (active after the swap) and
+                 'token_amounts'
+        """
+        payment_token_index = self._token_id[payment_token_label]
+        requested_token_index = self._token_id[requested_token_label]
+        payment_token_amounts = np.asarray(payment_token_amounts, dtype=np.float64)
+
+        path = np.zeros(len(payment_token_amounts), dtype=[('received_amount', np.float64), ('price', np.float64),
+                                                           ('slippage', np.float64), ('D', np.float64),
+                                                           ('amplification', np.float64),
+                                                           ('token_amounts', np.float64, len(self._token_amounts))])
+
+        price = self.get_price_by_index(payment_token_index, requested_token_index)
+        for i, payment_token_amount in enumerate(payment_token_amounts):
+            received_amount = self.exchange_by_index(payment_token_index, requested_token_index, payment_token_amount)
+
+            exchange_price = payment_token_amount / received_amount
+            if reverse_slippage:
+                path['slippage'][i] = (1 / exchange_price - 1 / price) * price
+            else:
+                path['slippage'][i] = (exchange_price - price) / price
+
+            price = self.get_price_by_index(payment_token_index, requested_token_index)
+            path['received_amount'][i] = received_amount
+            path['price'][i] = price
+            path['D'][i] = self.get_D()
+            path['amplification'][i] = self._last_amplification
+            path['token_amounts'][i] = self._token_amounts
+
+        return path
+
     def get_D(self):
         # computes the D value in StableSwap formula
-        return ut.curve_get_D(self._token_amounts, self._last_amplification)
+        solver_telemetry = ut.get_solver_telemetry()
+        if solver_telemetry is not None:
+            solver_telemetry.pricing_method = self._pricing_method
+        return self._get_D(self._last_amplification)
 
     def get_price_slippage(self, payment_token_label, requested_token_label, payment_token_amount,
                            reverse_slippage=False):
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+
+LATENCY_WINDOW = 1000  # number of most recent latencies kept per metric
+LATENCY_QUANTILES = [0.5, 0.95, 0.99]
+
+
+class LatencyMetrics:
+    # Rolling latency windows of named operations, e.g. Dash callbacks and their phases. Metrics are kept per server
+    # process, so each gunicorn worker reports its own.
+
+    def __init__(self, window=LATENCY_WINDOW):
+        """
+
+        :param window: number of most recent latencies kept per metric
+        """
+        self.window = window
+        self._latencies = {}
+        self._counts = {}
+        self._sums = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        """
+        Record a latency.
+        :param name: metric name, e.g. 'page_mcap.graph_update'
+        :param seconds: latency in seconds
+        """
+        with self._lock:
+            if name not in self._latencies:
+                self._latencies[name] = deque(maxlen=self.window)
+                self._counts[name] = 0
+                self._sums[name] = 0.0
+            self._latencies[name].append(seconds)
+            self._counts[name] += 1
+            self._sums[name] += seconds
+
+    @contextmanager
+    def timed(self, name):
+        # record the latency of a with block
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed_callback(self, name):
+        # decorator recording the latency of each call of a function
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timed(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def quantiles(self, name, quantiles=LATENCY_QUANTILES):
+        """
+        Compute latency quantiles over the rolling window of a metric.
+        :param name: metric name
+        :param quantiles: quantiles to compute, e.g. [0.5, 0.95, 0.99]
+        :return: list of latencies in seconds, one per quantile
+        """
+        with self._lock:
+            latencies = np.array(self._latencies[name])
+        return list(np.quantile(latencies, quantiles))
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus plain-text exposition format, as summaries with p50, p95 and p99 over
+        the rolling window and total count and sum.
+        :return: the metrics text
+        """
+        lines = ['# HELP callback_latency_seconds Latency of dashboard callbacks and their phases.',
+                 '# TYPE callback_latency_seconds summary']
+        with self._lock:
+            names = sorted(self._latencies)
+        for name in names:
+            for quantile, seconds in zip(LATENCY_QUANTILES, self.quantiles(name)):
+                lines.append('callback_latency_seconds{name="%s",quantile="%g"} %.6f' % (name, quantile, seconds))
+            lines.append('callback_latency_seconds_count{name="%s"} %d' % (name, self._counts[name]))
+            lines.append('callback_latency_seconds_sum{name="%s"} %.6f' % (name, self._sums[name]))
+        return '\n'.join(lines) + '\n'
+
+
+latency_metrics = LatencyMetrics()
@@ -0,0 +1,132 @@
+import argparse
+
+import numpy as np
+
+from pool_batch import PoolBatch
+
+TRADE_SIZE_DISTRIBUTIONS = ['lognormal', 'exponential', 'fixed']
+
+
+def draw_trade_sizes(rng, shape, size_distribution='lognormal', mean_trade_size=2000, size_sigma=1):
+    """
+    Draw random trade sizes.
+    :param rng: numpy random Generator
+    :param shape: shape of the returned array
+    :param size_distribution: one of TRADE_SIZE_DISTRIBUTIONS, or a function (rng, shape) -> sizes
+    :param mean_trade_size: mean trade size in tokens
+    :param size_sigma: standard deviation of the log of the size, for the lognormal distribution
+    :return: array of trade sizes
+    """
+    if callable(size_distribution):
+        return size_distribution(rng, shape)
+    elif size_distribution == 'lognormal':
+        return rng.lognormal(np.log(mean_trade_size) - size_sigma ** 2 / 2, size_sigma, shape)
+    elif size_distribution == 'exponential':
+        return rng.exponential(mean_trade_size, shape)
+    elif size_distribution == 'fixed':
+        return np.full(shape, float(mean_trade_size))
+    else:
+        raise ValueError('size_distribution not recognized')
+
+
+def run_monte_carlo(n_paths=2000, n_trades=200, initial_token_amounts=(50000, 50000), amplification=(85, 0.0001),
+                    size_distribution='lognormal', mean_trade_size=2000, size_sigma=1, drift=0, fee_ratio=0,
+                    price_floor=None, seed=None, return_paths=False):
+    """
+    Simulate random sequences of Boot buys and sells against Uniswap, Stableswap and Customswap pools, with every
+    pool type trading the same sequences, as in simulation.perform_simulation.
+    :param n_paths: number of random trade sequences
+    :param n_trades: number of trades per sequence
+    :param initial_token_amounts: initial amounts of Boot and USDC in the pools
+    :param amplification: customswap amplification factors [A1, A2], the stableswap pool uses A1
+    :param size_distribution: trade size distribution, see draw_trade_sizes
+    :param mean_trade_size: mean trade size, in Boot for sells and in USDC for buys
+    :param size_sigma: standard deviation of the log of the trade size, for the lognormal distribution
+    :param drift: order flow imbalance between -1 (only sells) and 1 (only buys), trades are buys with probability
+                  (1 + drift) / 2
+    :param fee_ratio: fee ratio of the pools
+    :param price_floor: Boot price support floor in USDC, by default the initial price
+    :param seed: seed of the random trade sequences
+    :param return_paths: also return the Boot price after every trade
+    :return: dictionary of pricing method -> dictionary of arrays of shape (n_paths,): 'final_price',
+             'max_drawdown' (largest relative drop of the price from its running maximum) and 'time_below_floor'
+             (fraction of trades after which the price is below the floor), and with return_paths 'prices' of shape
+             (n_paths, n_trades)
+    """
+    boot_index, usdc_index = 0, 1
+    rng = np.random.default_rng(seed)
+    buys = rng.random((n_trades, n_paths)) < (1 + drift) / 2
+    trade_sizes = draw_trade_sizes(rng, (n_trades, n_paths), size_distribution=size_distribution,
+                                   mean_trade_size=mean_trade_size, size_sigma=size_sigma)
+
+    pools = {'uniswap': PoolBatch(n_paths, initial_token_amounts, fee_ratio, 'uniswap'),
+             'stableswap': PoolBatch(n_paths, initial_token_amounts, fee_ratio, 'stableswap',
+                                     amplification=amplification[0]),
+             'customswap': PoolBatch(n_paths, initial_token_amounts, fee_ratio, 'customswap',
+                                     amplification=list(amplification), promoted_token_index=boot_index)}
+
+    results = {}
+    for pricing_method, pool in pools.items():
+        price = pool.get_price(usdc_index, boot_index)
+        if price_floor is None:
+            price_floor = float(price[0])
+
+        max_price = price.copy()
+        max_drawdown = np.zeros(n_paths)
+        trades_below_floor = np.zeros(n_paths)
+        prices = np.zeros((n_paths, n_trades)) if return_paths else None
+
+        for t in range(n_trades):
+            buy_rows = np.flatnonzero(buys[t])
+            sell_rows = np.flatnonzero(~buys[t])
+            if buy_rows.size > 0:
+                pool.exchange(buy_rows, usdc_index, boot_index, trade_sizes[t, buy_rows])
+            if sell_rows.size > 0:
+                pool.exchange(sell_rows, boot_index, usdc_index, trade_sizes[t, sell_rows])
+
+            price = pool.get_price(usdc_index, boot_index)
+            np.maximum(max_price, price, out=max_price)
+            np.maximum(max_drawdown, 1 - price / max_price, out=max_drawdown)
+            trades_below_floor += price < price_floor
+            if return_paths:
+                prices[:, t] = price
+
+        results[pricing_method] = {'final_price': price, 'max_drawdown': max_drawdown,
+                                   'time_below_floor': trades_below_floor / n_trades}
+        if return_paths:
+            results[pricing_method]['prices'] = prices
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monte Carlo simulation of random order flow in Uniswap, '
+                                                 'Stableswap and Customswap pools.')
+    parser.add_argument('--paths', type=int, default=2000, help='number of random trade sequences')
+    parser.add_argument('--trades', type=int, default=200, help='number of trades per sequence')
+    parser.add_argument('--a1', type=float, default=85, help='customswap A1, also used by the stableswap pool')
+    parser.add_argument('--a2', type=float, default=0.0001, help='customswap A2')
+    parser.add_argument('--sizes', choices=TRADE_SIZE_DISTRIBUTIONS, default='lognormal',
+                        help='trade size distribution')
+    parser.add_argument('--mean-trade-size', type=float, default=2000, help='mean trade size in tokens')
+    parser.add_argument('--size-sigma', type=float, default=1, help='standard deviation of the log trade size')
+    parser.add_argument('--drift', type=float, default=0, help='order flow imbalance, -1 only sells, 1 only buys')
+    parser.add_argument('--fee-ratio', type=float, default=0, help='fee ratio of the pools')
+    parser.add_argument('--floor', type=float, default=None, help='price support floor, default the initial price')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    args = parser.parse_args()
+
+    results = run_monte_carlo(n_paths=args.paths, n_trades=args.trades, amplification=[args.a1, args.a2],
+                              size_distribution=args.sizes, mean_trade_size=args.mean_trade_size,
+                              size_sigma=args.size_sigma, drift=args.drift, fee_ratio=args.fee_ratio,
+                              price_floor=args.floor, seed=args.seed)
+
+    print('%-12s %-18s %10s %10s %10s %10s' % ('pool', 'statistic', 'mean', 'p5', 'p50', 'p95'))
+    for pricing_method, statistics in results.items():
+        for name, values in statistics.items():
+            print('%-12s %-18s %10.4f %10.4f %10.4f %10.4f' % ((pricing_method, name, np.mean(values))
+                                                               + tuple(np.quantile(values, [0.05, 0.5, 0.95]))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+import numpy as np
+
+from pool_pair_price import final_price_for_liquidity_ratio, final_price_if_all_uniswap
+from result_store import result_store
+
+A_BOUNDS = (0.0001, 200)  # range of the A1 and A2 sliders of the market cap page
+TRANSITION_RATIO_BOUNDS = (0.5, 2)
+
+# scores to maximize, functions of (market cap saved, final price, arb drain, effective large sell price)
+OBJECTIVES = {
+    'market_cap_saved': lambda market_cap_saved, final_price, arb_drain, effective_large_sell_price:
+        market_cap_saved,
+    'arb_drain': lambda market_cap_saved, final_price, arb_drain, effective_large_sell_price: -arb_drain,
+    'effective_large_sell_price': lambda market_cap_saved, final_price, arb_drain, effective_large_sell_price:
+        effective_large_sell_price,
+}
+
+SURFACE_DTYPE = np.dtype([('a1', np.float64), ('a2', np.float64), ('amplification_transition_ratio', np.float64),
+                          ('final_price', np.float64), ('arb_drain', np.float64),
+                          ('effective_large_sell_price', np.float64), ('market_cap_saved', np.float64),
+                          ('score', np.float64), ('round', np.int64)])
+
+
+def _evaluate(point, uniswap_liquity_ratio, large_sell_ratio, boot_pool_token_num, arb_method):
+    # final price, arb drain and effective large sell price of one (A1, A2, transition ratio) candidate
+    a1, a2, amplification_transition_ratio = point
+    return final_price_for_liquidity_ratio(uniswap_liquity_ratio, large_sell_ratio=large_sell_ratio,
+                                           boot_token_num=boot_pool_token_num, amplification=[a1, a2],
+                                           arb_method=arb_method,
+                                           amplification_transition_ratio=amplification_transition_ratio)
+
+
+def _axis_values(low, high, n, log_scale):
+    if low == high:
+        return np.array([low])
+    values = np.logspace(np.log10(low), np.log10(high), n) if log_scale else np.linspace(low, high, n)
+    return np.clip(values, low, high)
+
+
+def _shrink(bounds, full_bounds, center, factor, log_scale):
+    # interval around center, factor times the width of bounds, clipped to full_bounds
+    low, high = bounds
+    if low == high:
+        return bounds
+    if log_scale:
+        low, high, center = np.log10(low), np.log10(high), np.log10(center)
+    half_width = (high - low) * factor / 2
+    low, high = center - half_width, center + half_width
+    if log_scale:
+        low, high = 10 ** low, 10 ** high
+    return max(low, full_bounds[0]), min(high, full_bounds[1])
+
+
+def optimize_amplification(uniswap_liquity_ratio=0.5, large_sell_ratio=0.1, boot_pool_token_num=100000,
+                           boot_total_token_num=1000000, objective='market_cap_saved',
+                           optimize_transition_ratio=False, amplification_transition_ratio=1,
+                           points_per_axis=5, shrink_factor=0.5, max_rounds=8, max_evaluations=1000,
+                           relative_tolerance=1e-4, target_score=None, arb_method='optimal', executor=None,
+                           max_workers=None, use_result_store=True):
+    """
+    Search A1, A2 and optionally the amplification transition ratio of the Customswap pool for the best objective
+    in the two pool setup of final_price_for_liquidity_ratio. Each round evaluates a grid over the current search
+    box (logarithmic in A) in parallel, then shrinks the box around the best point. The search stops after
+    max_rounds, after max_evaluations, when a round improves the best score by less than relative_tolerance, or
+    as soon as target_score is reached. Evaluated points are cached, in memory and in the result store.
+    :param uniswap_liquity_ratio: ratio of the liquidity in Uniswap
+    :param large_sell_ratio: size of the large sell relative to the pools
+    :param boot_pool_token_num: Boot in the two pools together
+    :param boot_total_token_num: circulating Boot supply, for market cap saved
+    :param objective: name in OBJECTIVES, or a function (market cap saved, final price, arb drain, effective large
+                      sell price) -> score to maximize
+    :param optimize_transition_ratio: also search the transition ratio within TRANSITION_RATIO_BOUNDS
+    :param amplification_transition_ratio: transition ratio used when it is not searched
+    :param points_per_axis: grid points per searched parameter in each round
+    :param shrink_factor: width of the next search box relative to the current one
+    :param max_rounds: maximum number of rounds
+    :param max_evaluations: maximum number of evaluated points
+    :param relative_tolerance: stop when a round improves the best score by less than this, relative to the score
+    :param target_score: stop as soon as a point reaches this score
+    :param arb_method: arbitrage method, see final_price_for_liquidity_ratio
+    :param executor: optional concurrent.futures executor evaluating the points
+    :param max_workers: number of worker processes created for this call if no executor is given, None uses all
+                        CPUs
+    :param use_result_store: look up and store evaluated points in result_store
+    :return: dictionary of the best 'a1', 'a2', 'amplification_transition_ratio' and 'score', and the explored
+             surface as a structured array of SURFACE_DTYPE with one record per evaluated point. Points scoring NaN
+             are skipped, and ValueError is raised if no point scores.
+    """
+    objective_function = OBJECTIVES[objective] if isinstance(objective, str) else objective
+    price_if_all_uniswap = final_price_if_all_uniswap(float(large_sell_ratio), arb_method)
+    evaluate = partial(_evaluate, uniswap_liquity_ratio=uniswap_liquity_ratio, large_sell_ratio=large_sell_ratio,
+                       boot_pool_token_num=boot_pool_token_num, arb_method=arb_method)
+
+    def store_inputs(point):
+        return list(point) + [uniswap_liquity_ratio, large_sell_ratio, boot_pool_token_num, arb_method]
+
+    owns_executor = executor is None
+    if owns_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    full_boxes = [A_BOUNDS, A_BOUNDS, TRANSITION_RATIO_BOUNDS if optimize_transition_ratio
+                  else (amplification_transition_ratio, amplification_transition_ratio)]
+    boxes = full_boxes
+    log_scales = [True, True, False]
+
+    evaluated = {}  # point -> (final price, arb drain, effective large sell price)
+    surface = []
+    best_point, best_score = None, -np.inf
+
+    def record(point, result, round_index):
+        nonlocal best_point, best_score
+        final_price, arb_drain, effective_large_sell_price = result
+        market_cap_saved = (final_price - price_if_all_uniswap) * boot_total_token_num
+        score = objective_function(market_cap_saved, final_price, arb_drain, effective_large_sell_price)
+        surface.append(point + (final_price, arb_drain, effective_large_sell_price, market_cap_saved, score,
+                                round_index))
+        # NaN scores, e.g. of a degenerate pool, are kept in the surface but never become the best point
+        if not np.isnan(score) and score > best_score:
+            best_point, best_score = point, score
+
+    try:
+        for round_index in range(max_rounds):
+            previous_best_score = best_score
+            grid = itertools.product(*[_axis_values(low, high, points_per_axis, log_scale)
+                                       for (low, high), log_scale in zip(boxes, log_scales)])
+            points = [tuple(float(value) for value in point) for point in grid]
+            points = [point for point in points if point not in evaluated][:max_evaluations - len(evaluated)]
+            if not points:
+                break
+
+            futures = {}
+            for point in points:
+                result = result_store.get('final_price_for_liquidity_ratio', store_inputs(point)) \
+                    if use_result_store else None
+                if result is not None:
+                    evaluated[point] = result
+                    record(point, result, round_index)
+                else:
+                    futures[executor.submit(evaluate, point)] = point
+
+            try:
+                for future in as_completed(futures):
+                    point = futures[future]
+                    evaluated[point] = future.result()
+                    if use_result_store:
+                        result_store.set('final_price_for_liquidity_ratio', store_inputs(point), evaluated[point])
+                    record(point, evaluated[point], round_index)
+                    if target_score is not None and best_score >= target_score:
+                        break
+            finally:
+                for future in futures:
+                    future.cancel()
+
+            if target_score is not None and best_score >= target_score:
+                break
+            if len(evaluated) >= max_evaluations:
+                break
+            if best_point is None:
+                break
+            if np.isfinite(previous_best_score) and \
+                    best_score - previous_best_score <= relative_tolerance * abs(previous_best_score):
+                break
+
+            boxes = [_shrink(bounds, full_bounds, center, shrink_factor, log_scale)
+                     for bounds, full_bounds, center, log_scale in zip(boxes, full_boxes, best_point, log_scales)]
+    finally:
+        if owns_executor:
+            executor.shutdown(cancel_futures=True)
+
+    if best_point is None:
+        raise ValueError('no evaluated point has a score for objective %r, e.g. all scores are NaN' % (objective,))
+    best = {'a1': best_point[0], 'a2': best_point[1], 'amplification_transition_ratio': best_point[2],
+            'score': float(best_score)}
+    return best, np.array(surface, dtype=SURFACE_DTYPE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search Customswap A1, A2 and the transition ratio for the best '
+                                                 'market cap saved or another objective.')
+    parser.add_argument('--uniswap-ratio', type=float, default=0.5, help='ratio of the liquidity in Uniswap')
+    parser.add_argument('--sell-ratio', type=float, default=0.1, help='large sell relative to the pools')
+    parser.add_argument('--pool-token-num', type=float, default=100000, help='Boot in the two pools together')
+    parser.add_argument('--total-token-num', type=float, default=1000000, help='circulating Boot supply')
+    parser.add_argument('--objective', choices=sorted(OBJECTIVES), default='market_cap_saved',
+                        help='objective to maximize')
+    parser.add_argument('--transition-ratio', action='store_true', help='also search the transition ratio')
+    parser.add_argument('--points-per-axis', type=int, default=5, help='grid points per parameter and round')
+    parser.add_argument('--max-rounds', type=int, default=8, help='maximum number of rounds')
+    parser.add_argument('--max-evaluations', type=int, default=1000, help='maximum number of evaluated points')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--output', help='.npy file to save the explored surface to')
+    args = parser.parse_args()
+
+    best, surface = optimize_amplification(uniswap_liquity_ratio=args.uniswap_ratio, large_sell_ratio=args.sell_ratio,
+                                           boot_pool_token_num=args.pool_token_num,
+                                           boot_total_token_num=args.total_token_num, objective=args.objective,
+                                           optimize_transition_ratio=args.transition_ratio,
+                                           points_per_axis=args.points_per_axis, max_rounds=args.max_rounds,
+                                           max_evaluations=args.max_evaluations, max_workers=args.workers)
+
+    print('evaluated %d points' % len(surface))
+    print('best: A1=%g A2=%g transition ratio=%g %s=%g' % (best['a1'], best['a2'],
+                                                            best['amplification_transition_ratio'], args.objective,
+                                                            best['score']))
+    if args.output:
+        np.save(args.output, surface)
+
+
+if __name__ == '__main__':
+    main()
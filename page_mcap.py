@@ -4,16 +4,31 @@
 # 3- Make price ratio slider logarithmic and go to ~100
 7
 
-from dash import html, callback
+from dash import html, callback, clientside_callback, no_update
 import plotly.graph_objects as go
 from dash import dcc
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 import numpy as np
 
+import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.append('..')
-from pool_pair_price import compute_market_cap_saved
+from response_surface import ResponseSurface
+from metrics import latency_metrics
+from result_cache import result_cache
+from result_store import result_store
+from sweep_jobs import market_cap_results, market_cap_sweep_jobs, stored_market_cap_results
+
+# worker processes shared by all market cap sweeps of this server process, SWEEP_WORKERS=0 runs them serially
+SWEEP_WORKERS = int(os.environ.get('SWEEP_WORKERS', 0))
+sweep_executor = ProcessPoolExecutor(max_workers=SWEEP_WORKERS) if SWEEP_WORKERS > 1 else None
+INLINE_SWEEP_WAIT = 0.3  # seconds a callback waits for its sweep job before polling it
+
+# precomputed tables built by response_surface.py, None if they have not been built
+response_surface = ResponseSurface.load()
 
 # app = dash.Dash(__name__)
 # app.title = 'Customswap Market Cap Saved Simulation'
@@ -78,7 +93,12 @@ layout = html.Div([
             fullscreen=False,
             children=html.Div(id="loading-output-1")
         ),
+        html.Div(id='mcap_job_error', style={'color': 'firebrick'}),
         dcc.Graph(id='prices_plot'),
+        dcc.Store(id='mcap_base_figures'),
+        dcc.Store(id='mcap_job_id'),
+        # polls the running sweep job for finished points, enabled while a job is running
+        dcc.Interval(id='mcap_poll_interval', interval=500, disabled=True),
     ], style={'padding': 10, 'flex': 1}),
     html.Div(children=[
 
@@ -88,28 +108,120 @@ layout = html.Div([
     ], style={'padding': 10, 'flex': 1})], style={'display': 'flex', 'flex-direction': 'row'}, )
 
 
-@callback(Output('market_cap_plot', 'figure'),
-          Output('prices_plot', 'figure'),
-          Output('arb_drain_plot', 'figure'),
-          Output('arb_drain_ratio_plot', 'figure'),
+@callback(Output('mcap_base_figures', 'data'),
+          Output('mcap_job_id', 'data'),
+          Output('mcap_poll_interval', 'disabled'),
+          Output('mcap_job_error', 'children'),
           Output("loading-output-1", "children"),
           [Input('A1', 'value'),
            Input('A2', 'value'),
-           Input('target_price', 'value'),
            Input('large_sell_ratio', 'value'),
            Input('num_total_tokens', 'value'),
-           Input('num_pool_tokens', 'value')])
-def graph_update(a1, a2, target_price, large_sell_ratio, num_total_tokens, num_pool_tokens):
+           Input('num_pool_tokens', 'value')],
+          State('mcap_job_id', 'data'))
+@latency_metrics.timed_callback('page_mcap.graph_update')
+def graph_update(a1, a2, large_sell_ratio, num_total_tokens, num_pool_tokens, job_id=None):
+    # answers from the precomputed tables or the caches when possible, otherwise starts a background job computing
+    # the routed results and the sweep. A job finishing within INLINE_SWEEP_WAIT is answered right away, a slower
+    # one is polled and its points are shown as they finish. The job of the previous inputs is cancelled.
+    if job_id is not None:
+        market_cap_sweep_jobs.cancel(job_id)
+
     arb_trade_boot_num = 1 + int(num_pool_tokens * 75 / 1000000)  # 50
 
     # print('num_tokens:', num_tokens)
     # print('arb_trade_boot_num:', arb_trade_boot_num)
 
+    with latency_metrics.timed('page_mcap.graph_update.simulation'):
+        results = lookup_results(a1, a2, large_sell_ratio, num_total_tokens, num_pool_tokens)
+        routed_key = [a1, a2, large_sell_ratio, num_total_tokens, num_pool_tokens]
+        routed_results = result_cache.get('compute_routed_market_cap_saved', routed_key)
+
+    if results is not None and routed_results is not None:
+        return build_figures(results, routed_results, large_sell_ratio, num_pool_tokens), None, True, None, None
+
+    job_id = market_cap_sweep_jobs.start(num_total_tokens, result_key=[a1, a2, large_sell_ratio, num_total_tokens,
+                                                                       num_pool_tokens],
+                                         routed_key=routed_key, run_sweep=results is None, large_uniswap_trade=True,
+                                         arb_trade_boot_num=arb_trade_boot_num, large_sell_ratio=large_sell_ratio,
+                                         arb_price_tolerance=0.03, amplification=[a1, a2],
+                                         boot_pool_token_num=num_pool_tokens, executor=sweep_executor)
+    progress = market_cap_sweep_jobs.wait(job_id, INLINE_SWEEP_WAIT)
+    if progress is not None and progress['done']:
+        figures, error = progress_figures(progress, a1, a2, large_sell_ratio, num_total_tokens, num_pool_tokens)
+        return figures, None, True, error, None
+
+    # the known results are shown right away, the routed results are added when the job has them
+    figures = build_figures(results, None, large_sell_ratio, num_pool_tokens) if results is not None else no_update
+    return figures, job_id, False, None, None
+
+
+def lookup_results(a1, a2, large_sell_ratio, num_total_tokens, num_pool_tokens):
+    # results of compute_market_cap_saved from the precomputed tables, the result store or the result cache, None if
+    # they have not been computed
+    results = None
+    if response_surface is not None:
+        results = response_surface.compute_market_cap_saved(num_total_tokens, large_sell_ratio, num_pool_tokens,
+                                                            amplification=[a1, a2])
+    # sweeps published by offline runs, they do not depend on the circulating supply
+    if results is None:
+        stored = result_store.get('market_cap_sweep', [a1, a2, large_sell_ratio, num_pool_tokens])
+        if stored is not None:
+            results = stored_market_cap_results(stored, num_total_tokens)
+    if results is None:
+        results = result_cache.get('compute_market_cap_saved',
+                                   [a1, a2, large_sell_ratio, num_total_tokens, num_pool_tokens])
+    return results
+
+
+# polling has its own callback without the loading output, so that the spinner does not flicker on every poll
+@callback(Output('mcap_base_figures', 'data', allow_duplicate=True),
+          Output('mcap_job_id', 'data', allow_duplicate=True),
+          Output('mcap_poll_interval', 'disabled', allow_duplicate=True),
+          Output('mcap_job_error', 'children', allow_duplicate=True),
+          Input('mcap_poll_interval', 'n_intervals'),
+          [State('A1', 'value'),
+           State('A2', 'value'),
+           State('large_sell_ratio', 'value'),
+           State('num_total_tokens', 'value'),
+           State('num_pool_tokens', 'value'),
+           State('mcap_job_id', 'data')],
+          prevent_initial_call=True)
+@latency_metrics.timed_callback('page_mcap.poll_sweep_job')
+def poll_sweep_job(n_intervals, a1, a2, large_sell_ratio, num_total_tokens, num_pool_tokens, job_id):
+    # figures of what the job has finished so far, polling stops when the job is done or has failed
+    progress = market_cap_sweep_jobs.get_progress(job_id) if job_id is not None else None
+    if progress is None:
+        return no_update, no_update, True, no_update
+
+    figures, error = progress_figures(progress, a1, a2, large_sell_ratio, num_total_tokens, num_pool_tokens)
+    if progress['done']:
+        return figures, None, True, error
+    return figures, no_update, False, no_update
+
+
+def progress_figures(progress, a1, a2, large_sell_ratio, num_total_tokens, num_pool_tokens):
+    # figures of what a sweep job has finished so far (no_update if nothing is finished yet) and the message of a
+    # failed job
+    if progress['error'] is not None:
+        return no_update, 'The simulation failed: %s' % progress['error']
+
+    # a job that only computes the routed results leaves the sweep results to the tables and caches
+    results = market_cap_results(progress, num_total_tokens) if progress['points'] else \
+        lookup_results(a1, a2, large_sell_ratio, num_total_tokens, num_pool_tokens)
+    if results is None or not len(results[0]):
+        return no_update, None
+
+    return build_figures(results, progress['routed_results'], large_sell_ratio, num_pool_tokens), None
+
+
+def build_figures(results, routed_results, large_sell_ratio, num_pool_tokens):
+    # builds the figures for a token price support floor of 1, they are scaled to the floor in the browser by the
+    # client-side callback below. results may cover only part of the liquidity ratios while a sweep is running.
+    figures_start = time.perf_counter()
+
     market_cap_saved_uni, final_prices_for_liquidity_ratio_uni, uniswap_liquity_ratios_uni, price_if_all_uniswap_uni, \
-    arb_drains1, effective_large_sell_prices = \
-        compute_market_cap_saved(boot_total_token_num=num_total_tokens, large_uniswap_trade=True, arb_trade_boot_num=arb_trade_boot_num,
-                                 large_sell_ratio=large_sell_ratio,  arb_price_tolerance=0.03,
-                                 amplification=[a1, a2], boot_pool_token_num=num_pool_tokens)
+    arb_drains1, effective_large_sell_prices = results
 
     # market_cap_saved_cus, final_prices_for_liquidity_ratio_cus, uniswap_liquity_ratios_cus, price_if_all_uniswap_cus, \
     # arb_drains2 = \
@@ -117,12 +229,26 @@ def graph_update(a1, a2, target_price, large_sell_ratio, num_total_tokens, num_p
     #                              large_sell_ratio=large_sell_ratio,
     #                              arb_price_tolerance=0.03, amplification=[a1, a2], boot_token_num=num_tokens)
 
+    # lists instead of arrays, so that the figures reach the browser as plain JSON arrays that can be scaled
+    market_cap_saved_uni = np.array(market_cap_saved_uni)
+    final_prices_for_liquidity_ratio_uni = np.array(final_prices_for_liquidity_ratio_uni)
+    uniswap_liquity_ratios_uni = np.array(uniswap_liquity_ratios_uni).tolist()
     arb_drains1 = np.array(arb_drains1)
     effective_large_sell_prices = np.array(effective_large_sell_prices)
 
+    # the large sale routed across both pools by an aggregator, which leaves nothing to arbitrage. routed_results is
+    # None until the sweep job has computed them.
+    if routed_results is not None:
+        market_cap_saved_routed, final_prices_routed, uniswap_liquity_ratios_routed, _, _ = routed_results
+    else:
+        market_cap_saved_routed, final_prices_routed, uniswap_liquity_ratios_routed = [], [], []
+    uniswap_liquity_ratios_routed = np.array(uniswap_liquity_ratios_routed).tolist()
+
     fig_cap = go.Figure(
-        [go.Scatter(x=uniswap_liquity_ratios_uni, y=market_cap_saved_uni * target_price, mode='lines+markers', \
+        [go.Scatter(x=uniswap_liquity_ratios_uni, y=market_cap_saved_uni.tolist(), mode='lines+markers', \
                     line=dict(color='firebrick', width=4), name='Large Trade in Uniswap'),
+         go.Scatter(x=uniswap_liquity_ratios_routed, y=np.array(market_cap_saved_routed).tolist(),
+                    mode='lines+markers', line=dict(color='royalblue', width=4), name='Large Trade Routed'),
 
          # go.Scatter(x=uniswap_liquity_ratios_cus, y=market_cap_saved_cus * target_price,
          #            mode='lines+markers', \
@@ -130,27 +256,30 @@ def graph_update(a1, a2, target_price, large_sell_ratio, num_total_tokens, num_p
          ])
 
     fig_prices = go.Figure([go.Scatter(x=uniswap_liquity_ratios_uni,
-                                       y=final_prices_for_liquidity_ratio_uni * target_price, mode='lines+markers', \
+                                       y=final_prices_for_liquidity_ratio_uni.tolist(), mode='lines+markers', \
                                        line=dict(color='firebrick', width=4), name='Large Trade in Uniswap'),
+                            go.Scatter(x=uniswap_liquity_ratios_routed, y=np.array(final_prices_routed).tolist(),
+                                       mode='lines+markers', line=dict(color='royalblue', width=4),
+                                       name='Large Trade Routed'),
                             ])
 
     fig_drains = go.Figure([go.Scatter(x=uniswap_liquity_ratios_uni,
-                                       y=arb_drains1 * final_prices_for_liquidity_ratio_uni * target_price,
+                                       y=(arb_drains1 * final_prices_for_liquidity_ratio_uni).tolist(),
                                        mode='lines+markers', \
                                        line=dict(color='firebrick', width=4), name='Large Trade in Uniswap'),
                             ])
 
 
     fig_drain_ratios = go.Figure([go.Scatter(x=uniswap_liquity_ratios_uni,
-                                       y=arb_drains1 * final_prices_for_liquidity_ratio_uni * target_price
-                                         / (num_pool_tokens * large_sell_ratio *
-                                            effective_large_sell_prices * target_price),
+                                       y=(arb_drains1 * final_prices_for_liquidity_ratio_uni
+                                          / (num_pool_tokens * large_sell_ratio *
+                                             effective_large_sell_prices)).tolist(),
                                        mode='lines+markers', \
                                        line=dict(color='firebrick', width=4), name='Large Trade in Uniswap'),
                             ])
 
     fig_prices.add_hline(
-        y=price_if_all_uniswap_uni * target_price, line_width=3, line_dash="dash",
+        y=price_if_all_uniswap_uni, line_width=3, line_dash="dash",
         annotation_text='Price if all in Uniswap', annotation_position="bottom",
         line_color="green")
 
@@ -162,7 +291,7 @@ def graph_update(a1, a2, target_price, large_sell_ratio, num_total_tokens, num_p
         'yanchor': 'top'},
         xaxis_title='Pool ratio in Uniswap (vs Customswap)',
         yaxis_title='Markep cap saved ($)',
-        yaxis_range=[0, 1.1 * np.max(market_cap_saved_uni) * target_price]
+        yaxis_range=[0, 1.1 * np.max(np.concatenate([market_cap_saved_uni, market_cap_saved_routed]))]
     )
 
     fig_prices.update_layout(title={
@@ -173,7 +302,7 @@ def graph_update(a1, a2, target_price, large_sell_ratio, num_total_tokens, num_p
         'yanchor': 'top'},
         xaxis_title='Pool ratio in Uniswap',
         yaxis_title='Token Price after Sale',
-        yaxis_range=[0, 1.1 * np.max(final_prices_for_liquidity_ratio_uni) * target_price]
+        yaxis_range=[0, 1.1 * np.max(np.concatenate([final_prices_for_liquidity_ratio_uni, final_prices_routed]))]
     )
 
     fig_drain_ratios.update_layout(title={
@@ -196,7 +325,44 @@ def graph_update(a1, a2, target_price, large_sell_ratio, num_total_tokens, num_p
         yaxis_title='Value of tokens drained by arb',
     )
 
-    return fig_cap, fig_prices, fig_drains, fig_drain_ratios, None
+    latency_metrics.observe('page_mcap.build_figures', time.perf_counter() - figures_start)
+
+    return [fig.to_dict() for fig in (fig_cap, fig_prices, fig_drains, fig_drain_ratios)]
+
+
+# scales the price dependent values of the figures to the token price support floor, so that editing the floor never
+# runs the simulation. The last figure is a ratio of values and does not depend on the floor.
+clientside_callback(
+    """
+    function(base_figures, target_price) {
+        if (!base_figures || target_price === null || target_price === undefined) {
+            return Array(4).fill(window.dash_clientside.no_update);
+        }
+        var figures = JSON.parse(JSON.stringify(base_figures));
+        var scale = function(value) { return value * target_price; };
+        for (var i = 0; i < 3; i++) {
+            var figure = figures[i];
+            figure.data.forEach(function(trace) { trace.y = trace.y.map(scale); });
+            if (figure.layout.yaxis && figure.layout.yaxis.range) {
+                figure.layout.yaxis.range = figure.layout.yaxis.range.map(scale);
+            }
+            (figure.layout.shapes || []).forEach(function(shape) {
+                shape.y0 = scale(shape.y0);
+                shape.y1 = scale(shape.y1);
+            });
+            (figure.layout.annotations || []).forEach(function(annotation) {
+                annotation.y = scale(annotation.y);
+            });
+        }
+        return figures;
+    }
+    """,
+    Output('market_cap_plot', 'figure'),
+    Output('prices_plot', 'figure'),
+    Output('arb_drain_plot', 'figure'),
+    Output('arb_drain_ratio_plot', 'figure'),
+    Input('mcap_base_figures', 'data'),
+    Input('target_price', 'value'))
 
 # ToDo:
 # 1- show as a plot, the percentage of tokens that were arbed compared to the to the total sale ratio.
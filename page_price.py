@@ -10,16 +10,23 @@
 
 
 import dash
-from dash import html, callback
+from dash import html, callback, clientside_callback
 import plotly.graph_objects as go
 from dash import dcc
 from dash.dependencies import Input, Output
 
 import sys
-import numpy as np
+import time
 
 sys.path.append('..')
 from simulation import perform_simulation
+from response_surface import ResponseSurface
+from metrics import latency_metrics
+from result_cache import result_cache
+from result_store import result_store
+
+# precomputed tables built by response_surface.py, None if they have not been built
+response_surface = ResponseSurface.load()
 
 # app = dash.Dash(__name__)
 # app.title = 'Customswap Simulation'
@@ -53,6 +60,7 @@ layout = html.Div([
             0: '0', 50: '50', 100: '100', 150: '150', 200: '200'},
                    tooltip={"placement": "bottom", "always_visible": True}),
         dcc.Graph(id='pr_uniswap_plot'),
+        dcc.Store(id='pr_base_figures'),
         html.Br(),
         html.Br(),
         html.A(
@@ -73,32 +81,47 @@ layout = html.Div([
     ], style={'padding': 10, 'flex': 1})], style={'display': 'flex', 'flex-direction': 'row'})
 
 
-@callback(Output('pr_uniswap_plot', 'figure'),
-          Output('pr_stableswap_plot', 'figure'),
-          Output('pr_customswap_plot', 'figure'),
+@callback(Output('pr_base_figures', 'data'),
           Output("pr_loading-output-1", "children"),
           [Input('A1', 'value'),
-           Input('A2', 'value'),
-           Input('target_price', 'value')])
-def graph_update(a1, a2, target_price):
+           Input('A2', 'value')])
+@latency_metrics.timed_callback('page_price.graph_update')
+def graph_update(a1, a2):
+    # builds the figures for a token price support floor of 1, they are scaled to the floor in the browser by the
+    # client-side callback below
+    with latency_metrics.timed('page_price.graph_update.simulation'):
+        # answer from the precomputed tables when they cover the inputs, otherwise run the simulation
+        results = None
+        if response_surface is not None:
+            results = response_surface.perform_simulation(a1=a1, a2=a2)
+        if results is None:
+            # results published by offline sweeps, live results go to the bounded result cache
+            results = result_store.get('perform_simulation', [a1, a2])
+        if results is None:
+            results = result_cache.get_or_compute('perform_simulation', [a1, a2],
+                                                  lambda: perform_simulation(a1=a1, a2=a2))
+
+    figures_start = time.perf_counter()
+
     prices1, prices2, price_slippages1, price_slippages2, token_ratio1, token_ratio2, \
-    amplifications1, amplifications2 = perform_simulation(a1=a1, a2=a2)
+    amplifications1, amplifications2 = results
 
     figs = []
     fig_labels = ['Uniswap', 'Stableswap', 'Customswap']
     for i in range(3):
-        fig = go.Figure([go.Scatter(x=token_ratio1[i, :] * target_price, y=prices1[i, :] * target_price, mode='lines+markers', \
+        # lists instead of arrays, so that the figures reach the browser as plain JSON arrays that can be scaled
+        fig = go.Figure([go.Scatter(x=token_ratio1[i, :].tolist(), y=prices1[i, :].tolist(), mode='lines+markers', \
                                     line=dict(color='firebrick', width=4), name='Token sales'),
-                         go.Scatter(x=token_ratio2[i, :] * target_price, y=prices2[i, :] * target_price, mode='lines+markers', \
+                         go.Scatter(x=token_ratio2[i, :].tolist(), y=prices2[i, :].tolist(), mode='lines+markers', \
                                     line=dict(color='blue', width=4), name='Token Purchases')
                          ])
 
         fig.update_xaxes(type="log", tickmode='array',
-                         tickvals=target_price * np.array([0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 25, 50, 100]),
+                         tickvals=[0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 25, 50, 100],
                          # ticktext = ['0.05', '0.1', '1', '100']
                          )
         fig.update_yaxes(type="log", tickmode='array',
-                         tickvals=target_price * np.array([0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 25, 50, 100]), )
+                         tickvals=[0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 25, 50, 100], )
         fig.update_layout(title={
             'text': fig_labels[i],
             'x': 0.45,
@@ -111,7 +134,37 @@ def graph_update(a1, a2, target_price):
 
         figs.append(fig)
 
-    return figs[0], figs[1], figs[2], None
+    latency_metrics.observe('page_price.graph_update.figures', time.perf_counter() - figures_start)
+
+    return [fig.to_dict() for fig in figs], None
+
+
+# scales both axes of the figures to the token price support floor, so that editing the floor never runs the
+# simulation
+clientside_callback(
+    """
+    function(base_figures, target_price) {
+        if (!base_figures || target_price === null || target_price === undefined) {
+            return Array(3).fill(window.dash_clientside.no_update);
+        }
+        var figures = JSON.parse(JSON.stringify(base_figures));
+        var scale = function(value) { return value * target_price; };
+        figures.forEach(function(figure) {
+            figure.data.forEach(function(trace) {
+                trace.x = trace.x.map(scale);
+                trace.y = trace.y.map(scale);
+            });
+            figure.layout.xaxis.tickvals = figure.layout.xaxis.tickvals.map(scale);
+            figure.layout.yaxis.tickvals = figure.layout.yaxis.tickvals.map(scale);
+        });
+        return figures;
+    }
+    """,
+    Output('pr_uniswap_plot', 'figure'),
+    Output('pr_stableswap_plot', 'figure'),
+    Output('pr_customswap_plot', 'figure'),
+    Input('pr_base_figures', 'data'),
+    Input('target_price', 'value'))
 
 # server = app.server  # for heroku
 
@@ -0,0 +1,146 @@
+import numpy as np
+
+import utils as ut
+from liquidity_pool import CUSTOMSWAP, PRICING_METHOD_IDS, STABLESWAP, UNISWAP, UNISWAP_AMPLIFICATION
+
+
+class PoolBatch:
+    # The same liquidity pool in many independent states (paths), advanced in lockstep with NumPy arrays. Follows
+    # LiquidityPool: D is carried across swaps without fee for the amplification factor used in the swap.
+
+    def __init__(self, n_paths, token_initial_amounts, fee_ratio, pricing_method,
+                 amplification=UNISWAP_AMPLIFICATION, promoted_token_index=0):
+        """
+
+        :param n_paths: number of pool states
+        :param token_initial_amounts: initial amounts of tokens, the same for all paths, or one row per path
+        :param fee_ratio: fee ratio, e.g. 0.03
+        :param pricing_method: one of {'uniswap', 'stableswap', 'customswap'}
+        :param amplification: amplification factor(s), see LiquidityPool
+        :param promoted_token_index: index of the customswap promoted token
+        """
+        if pricing_method not in PRICING_METHOD_IDS:
+            raise ValueError('pricing_method not recognized')
+
+        token_initial_amounts = np.asarray(token_initial_amounts, dtype=np.float64)
+        self.token_amounts = np.broadcast_to(token_initial_amounts, (n_paths, token_initial_amounts.shape[-1])).copy()
+        self.fee_ratio = fee_ratio
+        self.pricing_method = pricing_method
+        self._pricing_method_id = PRICING_METHOD_IDS[pricing_method]
+        self.amplification = amplification
+        self.amplification_transition_ratio = 1  # ratio of tokens at which A switches
+        self._promoted_token_index = promoted_token_index
+        self._non_promoted_token_indices = [i for i in range(self.token_amounts.shape[1])
+                                            if i != promoted_token_index]
+
+        # D of each path and the amplification factor it was computed with, NaN if D is not known
+        self._D = np.zeros(n_paths)
+        self._D_amplification = np.full(n_paths, np.nan)
+
+    @classmethod
+    def from_pool(cls, pool, n_paths):
+        """
+        Create pool states that all start as copies of a LiquidityPool.
+        :param pool: the LiquidityPool
+        :param n_paths: number of pool states
+        :return: the PoolBatch
+        """
+        promoted_token_index = pool.get_promoted_token_index()
+        pool_batch = cls(n_paths, pool.get_token_amounts(), pool.get_fee_ratio(), pool.get_pricing_method(),
+                         amplification=pool.get_amplification(),
+                         promoted_token_index=promoted_token_index if promoted_token_index is not None else 0)
+        pool_batch.amplification_transition_ratio = pool.amplification_transition_ratio
+        return pool_batch
+
+    def snapshot(self):
+        # mutable state of all pool states, see LiquidityPool.snapshot
+        return self.token_amounts.copy(), self._D.copy(), self._D_amplification.copy()
+
+    def restore(self, state):
+        # restore a state captured by snapshot(), any number of times
+        token_amounts, D, D_amplification = state
+        self.token_amounts = token_amounts.copy()
+        self._D = D.copy()
+        self._D_amplification = D_amplification.copy()
+
+    def get_amplification(self, token_amounts):
+        """
+        Amplification factor of each pool state, see LiquidityPool._get_customswap_amplification.
+        :param token_amounts: array of shape (n_states, n_coins)
+        :return: array of shape (n_states,)
+        """
+        if self._pricing_method_id == UNISWAP:
+            return np.full(len(token_amounts), UNISWAP_AMPLIFICATION)
+        elif self._pricing_method_id == STABLESWAP:
+            return np.full(len(token_amounts), float(self.amplification))
+
+        ratios = token_amounts[:, self._promoted_token_index] / \
+            token_amounts[:, self._non_promoted_token_indices].mean(axis=1)
+        return np.where(ratios > self.amplification_transition_ratio, self.amplification[0],
+                        self.amplification[-1])
+
+    def _get_D(self, rows, amplifications):
+        # D of the current token amounts of rows for the given amplification factors, solving only where unknown
+        stale = self._D_amplification[rows] != amplifications
+        if stale.any():
+            self._D[rows[stale]] = ut.curve_get_D_batch(self.token_amounts[rows[stale]], amplifications[stale])
+            self._D_amplification[rows[stale]] = amplifications[stale]
+        return self._D[rows]
+
+    def exchange(self, rows, payment_token_index, requested_token_index, payment_token_amounts):
+        """
+        Swap payment token with requested token in some of the pool states.
+        :param rows: increasing indices of the pool states that trade
+        :param payment_token_index: index of the payment token
+        :param requested_token_index: index of the requested token
+        :param payment_token_amounts: payment token amounts, one per row
+        :return: amounts of requested token sent back, one per row
+        """
+        x = self.token_amounts[rows]
+        payment_token_amounts_after = x[:, payment_token_index] + payment_token_amounts
+
+        if self._pricing_method_id == UNISWAP:
+            requested_token_amounts_after = x[:, requested_token_index] * x[:, payment_token_index] \
+                / payment_token_amounts_after
+        else:
+            amplifications = self.get_amplification(x)
+            requested_token_amounts_after = ut.curve_get_y_batch(payment_token_index, requested_token_index,
+                                                                 payment_token_amounts_after, x, amplifications,
+                                                                 D=self._get_D(rows, amplifications))
+
+            if self._pricing_method_id == CUSTOMSWAP:
+                # check if the condition for choosing the amplification factor still exists
+                potential_x = x.copy()
+                potential_x[:, payment_token_index] = payment_token_amounts_after
+                potential_x[:, requested_token_index] = requested_token_amounts_after
+                last_amplifications = self.get_amplification(potential_x)
+
+                changed = np.flatnonzero(last_amplifications != amplifications)
+                if changed.size > 0:
+                    requested_token_amounts_after[changed] = ut.curve_get_y_batch(
+                        payment_token_index, requested_token_index, payment_token_amounts_after[changed],
+                        x[changed], last_amplifications[changed],
+                        D=self._get_D(rows[changed], last_amplifications[changed]))
+
+        returned_token_amounts = (x[:, requested_token_index] - requested_token_amounts_after) * (1 - self.fee_ratio)
+        self.token_amounts[rows, payment_token_index] += payment_token_amounts
+        self.token_amounts[rows, requested_token_index] -= returned_token_amounts
+
+        # without fee D is unchanged for the amplification used in the swap, which _get_D left in self._D
+        if self.fee_ratio != 0:
+            self._D_amplification[rows] = np.nan
+
+        return returned_token_amounts
+
+    def get_price(self, payment_token_index, requested_token_index):
+        """
+        Marginal (spot) price of each pool state, see LiquidityPool.get_price.
+        :return: array of shape (n_paths,) with how much of payment token is needed per unit of requested token
+        """
+        if self._pricing_method_id == UNISWAP:
+            return self.token_amounts[:, payment_token_index] / self.token_amounts[:, requested_token_index]
+
+        rows = np.arange(len(self.token_amounts))
+        amplifications = self.get_amplification(self.token_amounts)
+        return ut.curve_get_spot_price_batch(payment_token_index, requested_token_index, self.token_amounts,
+                                             amplifications, D=self._get_D(rows, amplifications))
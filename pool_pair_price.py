@@ -1,12 +1,22 @@
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
 from liquidity_pool import LiquidityPool
+from pool_batch import PoolBatch
+
+BASELINE_CACHE_SIZE = 128  # number of all-Uniswap baseline prices kept by final_price_if_all_uniswap
+UNISWAP_LIQUITY_RATIOS = np.arange(0.05, 0.99, 1 / 30)  # ratios of the liquidity in Uniswap swept for market cap
 
 
 def final_price_for_liquidity_ratio(uniswap_liquity_ratio, arb_trade_boot_num=100,
                                     large_sell_ratio=0.1, boot_token_num=50000, amplification=None,
-                                    arb_price_tolerance=0.03, large_uniswap_trade=True):
+                                    arb_price_tolerance=0.03, large_uniswap_trade=True, arb_method='optimal',
+                                    return_arb_boot_gains=False, amplification_transition_ratio=1):
 
     # computes final price, after arbs, when a large sell trade happens in (Customswap, Uniswap) liquidity pool pair.
+    # arb_method is 'optimal' (arb trades sized by find_arb_trade_boot_num) or 'fixed_step' (arb trades of
+    # arb_trade_boot_num Boot). With return_arb_boot_gains the Boot gained in each arb trade is returned too.
+    # amplification_transition_ratio is the Boot to USDC ratio at which Customswap switches amplification.
 
     token_labels = ['Boot', 'USDC']
 
@@ -23,6 +33,7 @@ def final_price_for_liquidity_ratio(uniswap_liquity_ratio, arb_trade_boot_num=10
     lp_customswap = LiquidityPool(token_labels, customswap_token_amounts, fee_ratio=0,
                                   pricing_method='customswap', amplification=amplification,
                                   promoted_token_label='Boot')
+    lp_customswap.amplification_transition_ratio = amplification_transition_ratio
 
     # Perform one large sell trade of Boot token in Uniswap or Customswap pool
     large_sell_num_tokens = initial_token_amounts[0] * large_sell_ratio
@@ -51,7 +62,133 @@ def final_price_for_liquidity_ratio(uniswap_liquity_ratio, arb_trade_boot_num=10
 
     effective_large_sell_price = returned_token_amount / large_sell_num_tokens
 
-    # arbitrage simulation between the two pools until the price become very similar (to ~3% of each other)
+    # arbitrage between the two pools until the price become very similar (to ~3% of each other)
+    if arb_method == 'optimal':
+        arb_boot_gains = optimal_arbitrage(lp_uniswap, lp_customswap, arb_price_tolerance=arb_price_tolerance)
+    elif arb_method == 'fixed_step':
+        arb_boot_gains = fixed_step_arbitrage(lp_uniswap, lp_customswap, arb_trade_boot_num=arb_trade_boot_num,
+                                              arb_price_tolerance=arb_price_tolerance)
+    else:
+        raise ValueError('arb_method not recognized')
+
+    if large_uniswap_trade:
+        final_price = lp_uniswap.get_price(payment_token_label='USDC', requested_token_label='Boot')
+    else:
+        final_price = lp_customswap.get_price(payment_token_label='USDC', requested_token_label='Boot')
+
+    if return_arb_boot_gains:
+        return final_price, np.sum(arb_boot_gains), effective_large_sell_price, arb_boot_gains
+    return final_price, np.sum(arb_boot_gains), effective_large_sell_price
+
+
+def _arb_price_gap(lp_high, lp_low, boot_amount=0):
+    # relative Boot price gap between two pools after selling boot_amount Boot in lp_high, where Boot price is
+    # higher, and buying Boot in lp_low with the received USDC. The pools are restored afterwards.
+
+    lp_high_state = lp_high.snapshot()
+    lp_low_state = lp_low.snapshot()
+
+    high_boot_index, high_usdc_index = lp_high.get_token_index('Boot'), lp_high.get_token_index('USDC')
+    low_boot_index, low_usdc_index = lp_low.get_token_index('Boot'), lp_low.get_token_index('USDC')
+
+    if boot_amount > 0:
+        received_usdc_amount = lp_high.exchange_by_index(high_boot_index, high_usdc_index, boot_amount)
+        lp_low.exchange_by_index(low_usdc_index, low_boot_index, received_usdc_amount)
+
+    high_price = lp_high.get_price_by_index(high_usdc_index, high_boot_index)
+    low_price = lp_low.get_price_by_index(low_usdc_index, low_boot_index)
+
+    lp_high.restore(lp_high_state)
+    lp_low.restore(lp_low_state)
+
+    return (high_price - low_price) / ((high_price + low_price) / 2)
+
+
+def find_arb_trade_boot_num(lp_high, lp_low, arb_price_tolerance=0.03, relative_precision=1e-9, max_iterations=200):
+    """
+    Find the amount of Boot an arbitrageur sells in the pool where Boot price is higher (buying Boot back in the other
+    pool with the received USDC) so that the relative price gap between the pools shrinks to arb_price_tolerance.
+    The amount is bracketed by doubling and then found by bisection on the price gap.
+    :param lp_high: liquidity pool where Boot price is higher
+    :param lp_low: liquidity pool where Boot price is lower
+    :param arb_price_tolerance: relative price gap at which arbitrage stops, e.g. 0.03
+    :param relative_precision: relative precision of the returned amount
+    :param max_iterations: maximum number of bracketing or bisection iterations
+    :return: amount of Boot to sell in lp_high, the price gap after this trade is at most arb_price_tolerance
+    """
+
+    if _arb_price_gap(lp_high, lp_low) <= arb_price_tolerance:
+        return 0
+
+    low_boot_num = 0
+    high_boot_num = 1
+    for _ in range(max_iterations):
+        if _arb_price_gap(lp_high, lp_low, high_boot_num) <= arb_price_tolerance:
+            break
+        low_boot_num = high_boot_num
+        high_boot_num *= 2
+
+    for _ in range(max_iterations):
+        if high_boot_num - low_boot_num <= relative_precision * high_boot_num:
+            break
+        mid_boot_num = (low_boot_num + high_boot_num) / 2
+        if _arb_price_gap(lp_high, lp_low, mid_boot_num) <= arb_price_tolerance:
+            high_boot_num = mid_boot_num
+        else:
+            low_boot_num = mid_boot_num
+
+    return high_boot_num
+
+
+def optimal_arbitrage(lp_uniswap, lp_customswap, arb_price_tolerance=0.03, max_arb_trades=10):
+    """
+    Arbitrage between the two pools with trades sized to bring their Boot prices within arb_price_tolerance of each
+    other, usually in a single trade.
+    :param lp_uniswap: Uniswap liquidity pool
+    :param lp_customswap: Customswap liquidity pool
+    :param arb_price_tolerance: relative price gap at which arbitrage stops, e.g. 0.03
+    :param max_arb_trades: maximum number of arbitrage trades
+    :return: list of Boot gained by the arbitrageur in each trade
+    """
+
+    arb_boot_gains = []
+    for _ in range(max_arb_trades):
+        uniswap_price = lp_uniswap.get_price(payment_token_label='USDC', requested_token_label='Boot')
+        customswap_price = lp_customswap.get_price(payment_token_label='USDC', requested_token_label='Boot')
+
+        # sell Boot where its price is higher, then use the USDC money to buy Boot in the other pool
+        if customswap_price > uniswap_price:
+            lp_high, lp_low = lp_customswap, lp_uniswap
+        else:
+            lp_high, lp_low = lp_uniswap, lp_customswap
+
+        arb_trade_boot_num = find_arb_trade_boot_num(lp_high, lp_low, arb_price_tolerance=arb_price_tolerance)
+        if arb_trade_boot_num == 0:
+            break
+
+        received_usdc_amount = lp_high.exchange(payment_token_label='Boot',
+                                                requested_token_label='USDC',
+                                                payment_token_amount=arb_trade_boot_num)
+
+        received_boot_amount = lp_low.exchange(payment_token_label='USDC',
+                                               requested_token_label='Boot',
+                                               payment_token_amount=received_usdc_amount)
+
+        arb_boot_gains.append(received_boot_amount - arb_trade_boot_num)
+
+    return arb_boot_gains
+
+
+def fixed_step_arbitrage(lp_uniswap, lp_customswap, arb_trade_boot_num=100, arb_price_tolerance=0.03):
+    """
+    Arbitrage between the two pools with trades of arb_trade_boot_num Boot each, until their Boot prices are within
+    arb_price_tolerance of each other.
+    :param lp_uniswap: Uniswap liquidity pool
+    :param lp_customswap: Customswap liquidity pool
+    :param arb_trade_boot_num: amount of Boot sold in each arbitrage trade
+    :param arb_price_tolerance: relative price gap at which arbitrage stops, e.g. 0.03
+    :return: list of Boot gained by the arbitrageur in each trade
+    """
 
     uniswap_prices_before_arb = []
     customswap_prices_before_arb = []
@@ -107,38 +244,176 @@ def final_price_for_liquidity_ratio(uniswap_liquity_ratio, arb_trade_boot_num=10
         customswap_prices_after_arb.append(lp_customswap.get_price(payment_token_label='USDC',
                                                                    requested_token_label='Boot'))
 
-    if large_uniswap_trade:
-        return uniswap_prices_after_arb[-1], np.sum(arbBootGains), effective_large_sell_price
-    else:
-        return customswap_prices_after_arb[-1], np.sum(arbBootGains), effective_large_sell_price
+    return arbBootGains
+
+
+def route_sell_batch(pool_a, pool_b, sell_amounts, payment_token_index=0, requested_token_index=1,
+                     relative_precision=1e-9, max_iterations=100):
+    """
+    Split sells across two pools so that the received amount is largest, which is when the marginal prices of the
+    two pools after the sells are equal. Each row of the PoolBatch pools is an independent pool pair and sell. The
+    split is found by bisection on the marginal price difference, for all rows at once.
+    :param pool_a: PoolBatch of the first pool of each pair
+    :param pool_b: PoolBatch of the second pool of each pair
+    :param sell_amounts: amounts of payment token to sell, one per row
+    :param payment_token_index: index of the sold token, e.g. Boot
+    :param requested_token_index: index of the received token, e.g. USDC
+    :param relative_precision: precision of the split relative to the sell amount
+    :param max_iterations: maximum number of bisection iterations
+    :return: amounts sold in pool_a, amounts sold in pool_b, total received amounts, marginal prices of the sold
+             token in pool_a and in pool_b after the sells. The pools are left after the sells.
+    """
+    sell_amounts = np.asarray(sell_amounts, dtype=np.float64)
+    rows = np.arange(len(sell_amounts))
+    pool_a_state = pool_a.snapshot()
+    pool_b_state = pool_b.snapshot()
+
+    def sell(amounts_a):
+        # sell amounts_a in pool_a and the rest in pool_b, starting from the initial states
+        pool_a.restore(pool_a_state)
+        pool_b.restore(pool_b_state)
+        received_amounts = pool_a.exchange(rows, payment_token_index, requested_token_index, amounts_a) + \
+            pool_b.exchange(rows, payment_token_index, requested_token_index, sell_amounts - amounts_a)
+        return received_amounts, pool_a.get_price(requested_token_index, payment_token_index), \
+            pool_b.get_price(requested_token_index, payment_token_index)
+
+    # the price gap decreases with the amount sold in pool_a, from selling everything in pool_b to selling everything
+    # in pool_a. If it does not change sign, the whole amount goes to one pool.
+    _, price_a, price_b = sell(np.zeros(len(rows)))
+    low_amounts_a = np.where(price_a <= price_b, 0, np.nan)
+    _, price_a, price_b = sell(sell_amounts)
+    high_amounts_a = np.where(price_a >= price_b, sell_amounts, np.nan)
+
+    all_in_one_pool = ~np.isnan(low_amounts_a) | ~np.isnan(high_amounts_a)
+    low_amounts_a = np.where(all_in_one_pool, np.fmax(low_amounts_a, high_amounts_a), 0)
+    high_amounts_a = np.where(all_in_one_pool, low_amounts_a, sell_amounts)
+
+    for _ in range(max_iterations):
+        if np.all(high_amounts_a - low_amounts_a <= relative_precision * sell_amounts):
+            break
+        mid_amounts_a = (low_amounts_a + high_amounts_a) / 2
+        _, price_a, price_b = sell(mid_amounts_a)
+        low_amounts_a = np.where(price_a > price_b, mid_amounts_a, low_amounts_a)
+        high_amounts_a = np.where(price_a > price_b, high_amounts_a, mid_amounts_a)
+
+    amounts_a = (low_amounts_a + high_amounts_a) / 2
+    received_amounts, price_a, price_b = sell(amounts_a)
+    return amounts_a, sell_amounts - amounts_a, received_amounts, price_a, price_b
+
+
+def route_sell(lp_a, lp_b, payment_token_label, requested_token_label, sell_amounts, relative_precision=1e-9):
+    """
+    Split sells across two liquidity pools so that the received amount is largest, see route_sell_batch.
+    :param lp_a: first LiquidityPool, e.g. Uniswap
+    :param lp_b: second LiquidityPool, e.g. Customswap, with the same token labels
+    :param payment_token_label: sold token label, e.g. 'Boot'
+    :param requested_token_label: received token label, e.g. 'USDC'
+    :param sell_amounts: amount to sell, or array of amounts each routed separately from the current pool states
+    :param relative_precision: precision of the split relative to the sell amount
+    :return: amounts sold in lp_a, amounts sold in lp_b, total received amounts, marginal prices of the sold token in
+             lp_a and in lp_b after the sells. Scalars for a single amount, arrays otherwise. The pools are not
+             modified.
+    """
+    amounts = np.atleast_1d(np.asarray(sell_amounts, dtype=np.float64))
+    results = route_sell_batch(PoolBatch.from_pool(lp_a, len(amounts)), PoolBatch.from_pool(lp_b, len(amounts)),
+                               amounts, payment_token_index=lp_a.get_token_index(payment_token_label),
+                               requested_token_index=lp_a.get_token_index(requested_token_label),
+                               relative_precision=relative_precision)
+
+    if np.ndim(sell_amounts) == 0:
+        return tuple(float(result[0]) for result in results)
+    return results
+
+
+def compute_routed_market_cap_saved(boot_total_token_num, large_sell_ratio=0.1, boot_pool_token_num=1000000,
+                                    amplification=None, arb_method='optimal'):
+    """
+    Same sweep as compute_market_cap_saved, with the large sell routed across the Uniswap and Customswap pools
+    instead of sold in Uniswap and arbitraged. The routed sell leaves both pools at the same price, so there is no
+    arbitrage, and all liquidity ratios are solved at once.
+    :return: market cap saved, final prices, liquidity ratios, price if all liquidity was in Uniswap and effective
+             prices of the large sell
+    """
+    if amplification is None:
+        amplification = [85, 0.0001]
+
+    # same pools as final_price_for_liquidity_ratio, one row per liquidity ratio
+    initial_token_amounts = np.array([boot_pool_token_num, boot_pool_token_num])
+    uniswap_token_amounts = np.round(UNISWAP_LIQUITY_RATIOS[:, None] * initial_token_amounts)
+    customswap_token_amounts = initial_token_amounts - uniswap_token_amounts
+
+    n_ratios = len(UNISWAP_LIQUITY_RATIOS)
+    large_sell_num_tokens = np.full(n_ratios, initial_token_amounts[0] * large_sell_ratio, dtype=np.float64)
+    _, _, received_amounts, final_prices, _ = route_sell_batch(
+        PoolBatch(n_ratios, uniswap_token_amounts, 0, 'uniswap'),
+        PoolBatch(n_ratios, customswap_token_amounts, 0, 'customswap', amplification=amplification,
+                  promoted_token_index=0),
+        large_sell_num_tokens)
+
+    price_if_all_uniswap = final_price_if_all_uniswap(float(large_sell_ratio), arb_method)
+    market_cap_saved = (final_prices - price_if_all_uniswap) * boot_total_token_num
+
+    return market_cap_saved, final_prices, UNISWAP_LIQUITY_RATIOS, price_if_all_uniswap, \
+        received_amounts / large_sell_num_tokens
+
+
+@lru_cache(maxsize=BASELINE_CACHE_SIZE)
+def final_price_if_all_uniswap(large_sell_ratio=0.1, arb_method='optimal'):
+    """
+    Compute the final price after a large sell, when (almost) all the liquidity is in Uniswap. This baseline only
+    depends on the sell ratio, so it is memoized with LRU eviction; hits and misses are reported by
+    final_price_if_all_uniswap.cache_info().
+    :param large_sell_ratio: size of the large sell relative to the pool
+    :param arb_method: arbitrage method, see final_price_for_liquidity_ratio
+    :return: the final price of Boot in USDC
+    """
+    final_price, _, _ = final_price_for_liquidity_ratio(0.999,
+                                                        large_sell_ratio=large_sell_ratio,
+                                                        arb_trade_boot_num=1,
+                                                        arb_method=arb_method)
+    return final_price
 
 
 def compute_market_cap_saved(boot_total_token_num, large_sell_ratio=0.1, boot_pool_token_num=1000000,
                              large_uniswap_trade=True,
-                             arb_trade_boot_num=50, arb_price_tolerance=0.03, amplification=None):
+                             arb_trade_boot_num=50, arb_price_tolerance=0.03, amplification=None,
+                             arb_method='optimal', executor=None, max_workers=None, use_threads=False,
+                             chunksize=1):
 
     # compute market cap saved by adding Customswap compared to if all the liquidity was in a Uniswap pool.
+    # The liquidity ratios are independent and can be computed in parallel, either on a caller-supplied
+    # concurrent.futures executor (e.g. one kept alive by the Dash server), or on a pool of max_workers processes
+    # (threads if use_threads) created for this call. Results are always in the order of the liquidity ratios.
+
+    uniswap_liquity_ratios = UNISWAP_LIQUITY_RATIOS
+
+    final_price_for_ratio = partial(final_price_for_liquidity_ratio,
+                                    large_sell_ratio=large_sell_ratio,
+                                    arb_trade_boot_num=arb_trade_boot_num,
+                                    boot_token_num=boot_pool_token_num,
+                                    arb_price_tolerance=arb_price_tolerance,
+                                    large_uniswap_trade=large_uniswap_trade,
+                                    amplification=amplification,
+                                    arb_method=arb_method)
+
+    if executor is not None:
+        # the sweep is submitted first, so the baseline is computed here while the workers run
+        results = executor.map(final_price_for_ratio, uniswap_liquity_ratios, chunksize=chunksize)
+        price_if_all_uniswap = final_price_if_all_uniswap(float(large_sell_ratio), arb_method)
+        results = list(results)
+    elif max_workers is not None and max_workers > 1:
+        executor_class = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+        with executor_class(max_workers=max_workers) as sweep_executor:
+            results = sweep_executor.map(final_price_for_ratio, uniswap_liquity_ratios, chunksize=chunksize)
+            price_if_all_uniswap = final_price_if_all_uniswap(float(large_sell_ratio), arb_method)
+            results = list(results)
+    else:
+        results = [final_price_for_ratio(uniswap_liquity_ratio) for uniswap_liquity_ratio in uniswap_liquity_ratios]
+        price_if_all_uniswap = final_price_if_all_uniswap(float(large_sell_ratio), arb_method)
 
-    uniswap_liquity_ratios = np.arange(0.05, 0.99, 1 / 30)
-
-    final_prices_for_liquidity_ratio = []
-    arb_drains = []
-    effective_large_sell_prices = []
-    for uniswap_liquity_ratio in uniswap_liquity_ratios:
-        final_price, arb_drain, effective_large_sell_price = final_price_for_liquidity_ratio(uniswap_liquity_ratio,
-                                                                 large_sell_ratio=large_sell_ratio,
-                                                                 arb_trade_boot_num=arb_trade_boot_num,
-                                                                 boot_token_num=boot_pool_token_num,
-                                                                 arb_price_tolerance=arb_price_tolerance,
-                                                                 large_uniswap_trade=large_uniswap_trade,
-                                                                 amplification=amplification)
-        final_prices_for_liquidity_ratio.append(final_price)
-        arb_drains.append(arb_drain)
-        effective_large_sell_prices.append(effective_large_sell_price)
-
-    price_if_all_uniswap, _, _ = final_price_for_liquidity_ratio(0.999,
-                                                           large_sell_ratio=large_sell_ratio,
-                                                           arb_trade_boot_num=1)
+    final_prices_for_liquidity_ratio = [final_price for final_price, _, _ in results]
+    arb_drains = [arb_drain for _, arb_drain, _ in results]
+    effective_large_sell_prices = [effective_large_sell_price for _, _, effective_large_sell_price in results]
 
     final_prices_for_liquidity_ratio = np.array(final_prices_for_liquidity_ratio)
     market_cap_saved = (final_prices_for_liquidity_ratio - price_if_all_uniswap) * boot_total_token_num
@@ -148,6 +423,41 @@ def compute_market_cap_saved(boot_total_token_num, large_sell_ratio=0.1, boot_po
            arb_drains, effective_large_sell_prices
 
 
+def iterate_market_cap_sweep(large_sell_ratio=0.1, boot_pool_token_num=1000000, large_uniswap_trade=True,
+                             arb_trade_boot_num=50, arb_price_tolerance=0.03, amplification=None,
+                             arb_method='optimal', executor=None):
+    """
+    Compute the points of the compute_market_cap_saved sweep one at a time, yielding each point as soon as it is
+    finished, e.g. to show progress. Closing the generator cancels the points that have not started yet.
+    :param executor: optional concurrent.futures executor computing the points in parallel, points are then yielded
+                     in the order they finish
+    :return: generator of (index into UNISWAP_LIQUITY_RATIOS, (final price, arb drain, effective large sell price))
+    """
+
+    final_price_for_ratio = partial(final_price_for_liquidity_ratio,
+                                    large_sell_ratio=large_sell_ratio,
+                                    arb_trade_boot_num=arb_trade_boot_num,
+                                    boot_token_num=boot_pool_token_num,
+                                    arb_price_tolerance=arb_price_tolerance,
+                                    large_uniswap_trade=large_uniswap_trade,
+                                    amplification=amplification,
+                                    arb_method=arb_method)
+
+    if executor is None:
+        for index, uniswap_liquity_ratio in enumerate(UNISWAP_LIQUITY_RATIOS):
+            yield index, final_price_for_ratio(uniswap_liquity_ratio)
+        return
+
+    futures = {executor.submit(final_price_for_ratio, uniswap_liquity_ratio): index
+               for index, uniswap_liquity_ratio in enumerate(UNISWAP_LIQUITY_RATIOS)}
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
 def plot_saved_market_cap():
     # create final price and market cap saved plots.
     import matplotlib.pyplot as plt
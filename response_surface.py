@@ -0,0 +1,307 @@
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pool_pair_price import UNISWAP_LIQUITY_RATIOS, compute_market_cap_saved
+from result_store import model_version
+from simulation import perform_simulation
+
+# tables built by `python response_surface.py`, used by the dashboard pages when the file exists
+RESPONSE_SURFACE_PATH = os.environ.get('RESPONSE_SURFACE_PATH',
+                                       os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                    'response_surface.npz'))
+
+# maximum relative interpolation error, estimated when building the tables, up to which the tables answer a query.
+# Queries in grid cells with a larger error are computed exactly by the pages.
+RESPONSE_SURFACE_TOLERANCE = float(os.environ.get('RESPONSE_SURFACE_TOLERANCE', 0.01))
+
+SLIDER_DEFAULT_A_VALUES = [85, 0.0001]  # default A1 and A2 of the dashboard pages, always grid values
+DEFAULT_A_VALUES = np.union1d(np.logspace(-4, np.log10(200), 25), SLIDER_DEFAULT_A_VALUES)
+DEFAULT_SIMULATION_A_VALUES = np.union1d(np.logspace(-4, np.log10(200), 49), SLIDER_DEFAULT_A_VALUES)
+# perform_simulation outputs stored and interpolated in log scale: the amplification factors, which are then exact
+# between grid values where the amplification regimes of the pools do not change
+LOG_SIMULATION_OUTPUTS = [6, 7]
+DEFAULT_LARGE_SELL_RATIOS = np.concatenate([[0.0001], np.arange(0.05, 2.0001, 0.05)])
+DEFAULT_BOOT_POOL_TOKEN_NUM = 100000
+
+
+def _compute_market_cap_cell(cell):
+    # market cap sweep of one (A1, A2, large sell ratio) grid cell, per circulating token and per pool token
+    a1, a2, large_sell_ratio, boot_pool_token_num = cell
+
+    _, final_prices, _, price_if_all_uniswap, arb_drains, effective_large_sell_prices = \
+        compute_market_cap_saved(boot_total_token_num=1, large_sell_ratio=large_sell_ratio,
+                                 boot_pool_token_num=boot_pool_token_num, amplification=[a1, a2])
+
+    return final_prices, np.array(arb_drains) / boot_pool_token_num, np.array(effective_large_sell_prices), \
+        price_if_all_uniswap
+
+
+def _compute_simulation_cell(cell):
+    # results of perform_simulation, with the amplification factors in log scale
+    a1, a2 = cell
+    simulation = np.array(perform_simulation(a1=a1, a2=a2))
+    simulation[LOG_SIMULATION_OUTPUTS] = np.log(simulation[LOG_SIMULATION_OUTPUTS])
+    return simulation
+
+
+def _relative_errors(interpolated, exact, axes):
+    # largest absolute error over axes relative to the largest absolute exact value
+    return np.max(np.abs(interpolated - exact), axis=axes) / np.maximum(np.max(np.abs(exact), axis=axes), 1e-300)
+
+
+def _cell_centers(values, log_scale=True):
+    # centers of the grid cells, in log scale or linear scale
+    return np.sqrt(values[:-1] * values[1:]) if log_scale else (values[:-1] + values[1:]) / 2
+
+
+def _corner_mean(table, n_axes=2):
+    # interpolated values at the centers of the cells of the n_axes leading axes
+    corners = [table[tuple(slice(1, None) if upper else slice(None, -1) for upper in corner)]
+               for corner in itertools.product([0, 1], repeat=n_axes)]
+    return np.mean(corners, axis=0)
+
+
+def build_response_surface(path=RESPONSE_SURFACE_PATH, a1_values=DEFAULT_A_VALUES, a2_values=DEFAULT_A_VALUES,
+                           large_sell_ratios=DEFAULT_LARGE_SELL_RATIOS,
+                           boot_pool_token_num=DEFAULT_BOOT_POOL_TOKEN_NUM,
+                           simulation_a_values=DEFAULT_SIMULATION_A_VALUES, max_workers=None, chunksize=4):
+    """
+    Sweep compute_market_cap_saved and perform_simulation over a grid of (A1, A2, large sell ratio) in parallel and
+    save the results as compressed arrays. Arb drains are stored relative to the pool size, which they are
+    proportional to, so the tables serve any pool size. The interpolation error of each grid cell is estimated by
+    computing the results exactly at the cell centers, in A1 and A2 and in the large sell ratio for the market cap
+    tables, and stored with the tables along with the model version.
+    :param path: output .npz file
+    :param a1_values: increasing grid values of A1 for the market cap tables
+    :param a2_values: increasing grid values of A2 for the market cap tables
+    :param large_sell_ratios: increasing grid values of the large sell ratio
+    :param boot_pool_token_num: pool size used for the sweep
+    :param simulation_a_values: increasing grid values of A1 and A2 for the price simulation tables
+    :param max_workers: number of worker processes, None uses all CPUs
+    :param chunksize: number of grid cells sent to a worker at a time
+    """
+    a1_values = np.asarray(a1_values, dtype=np.float64)
+    a2_values = np.asarray(a2_values, dtype=np.float64)
+    large_sell_ratios = np.asarray(large_sell_ratios, dtype=np.float64)
+    simulation_a_values = np.asarray(simulation_a_values, dtype=np.float64)
+
+    def market_cap_cells(a1s, a2s, sell_ratios):
+        return [(a1, a2, large_sell_ratio, boot_pool_token_num)
+                for a1, a2, large_sell_ratio in itertools.product(a1s, a2s, sell_ratios)]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        market_cap_results = list(executor.map(_compute_market_cap_cell,
+                                               market_cap_cells(a1_values, a2_values, large_sell_ratios),
+                                               chunksize=chunksize))
+        center_market_cap_results = list(executor.map(
+            _compute_market_cap_cell, market_cap_cells(_cell_centers(a1_values), _cell_centers(a2_values),
+                                                       _cell_centers(large_sell_ratios, log_scale=False)),
+            chunksize=chunksize))
+        simulation_results = list(executor.map(_compute_simulation_cell,
+                                               itertools.product(simulation_a_values, simulation_a_values),
+                                               chunksize=chunksize))
+        center_simulation_results = list(executor.map(_compute_simulation_cell,
+                                                      itertools.product(_cell_centers(simulation_a_values),
+                                                                        _cell_centers(simulation_a_values)),
+                                                      chunksize=chunksize))
+
+    grid_shape = (len(a1_values), len(a2_values), len(large_sell_ratios))
+    final_prices, arb_drain_ratios, effective_large_sell_prices, prices_if_all_uniswap = \
+        [np.array(values).reshape(grid_shape + np.shape(values[0])) for values in zip(*market_cap_results)]
+    center_shape = (len(a1_values) - 1, len(a2_values) - 1, len(large_sell_ratios) - 1)
+    center_final_prices, center_arb_drain_ratios, center_effective_large_sell_prices, _ = \
+        [np.array(values).reshape(center_shape + np.shape(values[0])) for values in zip(*center_market_cap_results)]
+
+    # errors per (A1 cell, A2 cell, large sell ratio cell), the largest over the outputs and liquidity ratios
+    market_cap_errors = np.max([_relative_errors(_corner_mean(table, 3), center_table, -1)
+                                for table, center_table in [(final_prices, center_final_prices),
+                                                            (arb_drain_ratios, center_arb_drain_ratios),
+                                                            (effective_large_sell_prices,
+                                                             center_effective_large_sell_prices)]], axis=0)
+
+    simulation_shape = (len(simulation_a_values), len(simulation_a_values))
+    simulations = np.array(simulation_results).reshape(simulation_shape + (8, 3, -1))
+    center_simulations = np.array(center_simulation_results).reshape(
+        (len(simulation_a_values) - 1, len(simulation_a_values) - 1) + (8, 3, -1))
+    # errors per (A1 cell, A2 cell), the largest over the outputs as served, each relative to its largest value
+    interpolated_simulations = _corner_mean(simulations)
+    for table in (interpolated_simulations, center_simulations):
+        table[..., LOG_SIMULATION_OUTPUTS, :, :] = np.exp(table[..., LOG_SIMULATION_OUTPUTS, :, :])
+    simulation_errors = np.max(_relative_errors(interpolated_simulations, center_simulations, (-2, -1)), axis=-1)
+
+    np.savez_compressed(path,
+                        model_version=model_version(),
+                        a1_values=a1_values,
+                        a2_values=a2_values,
+                        large_sell_ratios=large_sell_ratios,
+                        uniswap_liquity_ratios=UNISWAP_LIQUITY_RATIOS,
+                        boot_pool_token_num=boot_pool_token_num,
+                        final_prices=final_prices,
+                        arb_drain_ratios=arb_drain_ratios,
+                        effective_large_sell_prices=effective_large_sell_prices,
+                        prices_if_all_uniswap=prices_if_all_uniswap[0, 0],
+                        market_cap_errors=market_cap_errors,
+                        simulation_a_values=simulation_a_values,
+                        simulations=simulations,
+                        simulation_errors=simulation_errors)
+
+    print('largest interpolation error: market cap %.3g, price simulation %.3g'
+          % (market_cap_errors.max(), simulation_errors.max()))
+
+
+def _interpolation_weights(grid_values, value, log_scale):
+    # lower grid index and weight of the upper grid value for linear interpolation, None if value is off-grid
+
+    if log_scale:
+        grid_values = np.log(grid_values)
+        value = np.log(value)
+
+    if not grid_values[0] <= value <= grid_values[-1]:
+        return None
+
+    index = int(np.clip(np.searchsorted(grid_values, value, side='right') - 1, 0, len(grid_values) - 2))
+    weight = (value - grid_values[index]) / (grid_values[index + 1] - grid_values[index])
+    return index, weight
+
+
+def interpolate_grid(table, grid_values, values, log_scales, errors=None, tolerance=None):
+    """
+    Multilinear interpolation of a table over its leading axes.
+    :param table: array whose leading axes correspond to grid_values
+    :param grid_values: list of increasing grid values of each leading axis, at least two per axis
+    :param values: list of values to interpolate at, one per leading axis
+    :param log_scales: list of booleans, interpolate linearly in log(value) for axes where this is true
+    :param errors: optional array of estimated interpolation errors over the grid cells (one less than the grid
+                   values) of the leading axes
+    :param tolerance: largest accepted error, if errors is given
+    :return: the interpolated sub-array, or None if a value is outside its grid or the estimated error of its grid
+             cell is above tolerance
+    """
+    weights = [_interpolation_weights(np.asarray(axis_values), value, log_scale)
+               for axis_values, value, log_scale in zip(grid_values, values, log_scales)]
+    if any(weight is None for weight in weights):
+        return None
+
+    # values on grid points are exact, the error is then irrelevant
+    if errors is not None and not all(min(weight, 1 - weight) < 1e-9 for _, weight in weights):
+        if errors[tuple(index for index, _ in weights)] > tolerance:
+            return None
+
+    result = 0
+    for corner in itertools.product([0, 1], repeat=len(weights)):
+        corner_weight = np.prod([weight if upper else 1 - weight for (_, weight), upper in zip(weights, corner)])
+        if corner_weight > 0:
+            result = result + corner_weight * table[tuple(index + upper for (index, _), upper in zip(weights, corner))]
+
+    return result
+
+
+class ResponseSurface:
+    # Precomputed market cap and price simulation tables, answering dashboard queries by interpolation.
+
+    def __init__(self, path=RESPONSE_SURFACE_PATH, tolerance=RESPONSE_SURFACE_TOLERANCE):
+        """
+
+        :param path: .npz file written by build_response_surface
+        :param tolerance: largest estimated relative interpolation error of answered queries
+        """
+        with np.load(path) as tables:
+            self._tables = {name: tables[name] for name in tables.files}
+        self.tolerance = tolerance
+
+    @classmethod
+    def load(cls, path=RESPONSE_SURFACE_PATH, tolerance=RESPONSE_SURFACE_TOLERANCE):
+        """
+        Load the tables if they have been built with the current model.
+        :param path: .npz file written by build_response_surface
+        :param tolerance: largest estimated relative interpolation error of answered queries
+        :return: the ResponseSurface, or None if the tables have not been built or were built with another model
+                 version
+        """
+        if not os.path.exists(path):
+            return None
+
+        response_surface = cls(path, tolerance=tolerance)
+        if str(response_surface._tables.get('model_version')) != model_version():
+            print('Ignoring %s, it was built with another model version' % path)
+            return None
+        return response_surface
+
+    def compute_market_cap_saved(self, boot_total_token_num, large_sell_ratio, boot_pool_token_num, amplification):
+        """
+        Interpolated equivalent of pool_pair_price.compute_market_cap_saved.
+        :return: same results as compute_market_cap_saved, or None if the parameters are off-grid or the estimated
+                 interpolation error is above the tolerance
+        """
+        grid_values = [self._tables['a1_values'], self._tables['a2_values'], self._tables['large_sell_ratios']]
+        values = [amplification[0], amplification[1], large_sell_ratio]
+
+        final_prices = interpolate_grid(self._tables['final_prices'], grid_values, values, [True, True, False],
+                                        errors=self._tables['market_cap_errors'], tolerance=self.tolerance)
+        if final_prices is None:
+            return None
+
+        arb_drain_ratios = interpolate_grid(self._tables['arb_drain_ratios'], grid_values, values,
+                                            [True, True, False])
+        effective_large_sell_prices = interpolate_grid(self._tables['effective_large_sell_prices'], grid_values,
+                                                       values, [True, True, False])
+        price_if_all_uniswap = interpolate_grid(self._tables['prices_if_all_uniswap'], grid_values[2:], values[2:],
+                                                [False])
+
+        market_cap_saved = (final_prices - price_if_all_uniswap) * boot_total_token_num
+
+        return market_cap_saved, final_prices, self._tables['uniswap_liquity_ratios'], float(price_if_all_uniswap), \
+            list(arb_drain_ratios * boot_pool_token_num), list(effective_large_sell_prices)
+
+    def perform_simulation(self, a1=85, a2=0.0001):
+        """
+        Interpolated equivalent of simulation.perform_simulation.
+        :return: same results as perform_simulation, or None if the parameters are off-grid or the estimated
+                 interpolation error is above the tolerance
+        """
+        simulation = interpolate_grid(self._tables['simulations'],
+                                      [self._tables['simulation_a_values'], self._tables['simulation_a_values']],
+                                      [a1, a2], [True, True], errors=self._tables['simulation_errors'],
+                                      tolerance=self.tolerance)
+        if simulation is None:
+            return None
+
+        simulation[LOG_SIMULATION_OUTPUTS] = np.exp(simulation[LOG_SIMULATION_OUTPUTS])
+        return tuple(simulation)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute the dashboard response surface tables.')
+    parser.add_argument('--output', default=RESPONSE_SURFACE_PATH, help='output .npz file')
+    parser.add_argument('--a-min', type=float, default=1e-4, help='smallest A1 and A2')
+    parser.add_argument('--a-max', type=float, default=200, help='largest A1 and A2')
+    parser.add_argument('--a-num', type=int, default=25,
+                        help='number of log-spaced A1 and A2 values of the market cap tables')
+    parser.add_argument('--simulation-a-num', type=int, default=49,
+                        help='number of log-spaced A1 and A2 values of the price simulation tables')
+    parser.add_argument('--sell-ratio-step', type=float, default=0.05, help='step of the large sell ratio grid')
+    parser.add_argument('--sell-ratio-max', type=float, default=2, help='largest large sell ratio')
+    parser.add_argument('--pool-token-num', type=float, default=DEFAULT_BOOT_POOL_TOKEN_NUM,
+                        help='pool size used for the sweep')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    # the slider defaults are added to the grids, the pages answer them exactly
+    a_values = np.union1d(np.logspace(np.log10(args.a_min), np.log10(args.a_max), args.a_num),
+                          SLIDER_DEFAULT_A_VALUES)
+    simulation_a_values = np.union1d(np.logspace(np.log10(args.a_min), np.log10(args.a_max), args.simulation_a_num),
+                                     SLIDER_DEFAULT_A_VALUES)
+    large_sell_ratios = np.concatenate([[0.0001], np.arange(args.sell_ratio_step,
+                                                            args.sell_ratio_max + 1e-9, args.sell_ratio_step)])
+
+    build_response_surface(args.output, a1_values=a_values, a2_values=a_values, large_sell_ratios=large_sell_ratios,
+                           boot_pool_token_num=args.pool_token_num, simulation_a_values=simulation_a_values,
+                           max_workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+import numpy as np
+
+# the cache is shared by all server processes (e.g. gunicorn workers) through an SQLite file. By default the file is
+# in a directory private to the user running the app, created with 0700 permissions. Setting RESULT_CACHE_PATH to an
+# empty string disables it.
+DEFAULT_RESULT_CACHE_DIRECTORY = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                                             os.path.join(os.path.expanduser('~'), '.cache')),
+                                              'customswap')
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH',
+                                   os.path.join(DEFAULT_RESULT_CACHE_DIRECTORY, 'result_cache.sqlite'))
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 2000))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 24 * 60 * 60))  # seconds
+MODEL_FILES = ('liquidity_pool.py', 'pool_batch.py', 'utils.py', 'jit_kernels.py', 'pool_pair_price.py',
+               'simulation.py')
+
+
+def model_version(files=MODEL_FILES):
+    """
+    Version of the model, a hash of the source files computing the results.
+    :param files: source files, relative to this directory
+    :return: hexadecimal hash
+    """
+    digest = hashlib.sha256()
+    for name in files:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as f:
+            digest.update(name.encode() + b'\0' + f.read() + b'\0')
+    return digest.hexdigest()[:16]
+
+
+def normalize_inputs(inputs):
+    """
+    Normalize callback inputs so that equal states give equal cache keys, e.g. 85 and 85.0 from a slider.
+    :param inputs: number, string, None or (nested) list/tuple of those
+    :return: a JSON compatible normalized copy of the inputs
+    """
+    if isinstance(inputs, (list, tuple)):
+        return [normalize_inputs(value) for value in inputs]
+    elif isinstance(inputs, bool) or inputs is None or isinstance(inputs, str):
+        return inputs
+    else:
+        return repr(float(inputs))
+
+
+def encode_value(value):
+    """
+    Encode a result as JSON, without pickles. Arrays are stored as base64 encoded .npy data.
+    :param value: number, string, bool, None, numpy array or scalar, or (nested) list, tuple or dictionary of those
+    :return: JSON string
+    """
+    def encode(item):
+        if isinstance(item, np.ndarray):
+            buffer = io.BytesIO()
+            np.save(buffer, item, allow_pickle=False)
+            return {'__ndarray__': base64.b64encode(buffer.getvalue()).decode('ascii')}
+        elif isinstance(item, np.generic):
+            return item.item()
+        elif isinstance(item, tuple):
+            return {'__tuple__': [encode(element) for element in item]}
+        elif isinstance(item, list):
+            return [encode(element) for element in item]
+        elif isinstance(item, dict):
+            # keys keep their type, e.g. integer indices
+            return {'__dict__': [[encode(key), encode(element)] for key, element in item.items()]}
+        elif item is None or isinstance(item, (bool, int, float, str)):
+            return item
+        raise TypeError('ResultCache can not store values of type %s' % type(item).__name__)
+
+    return json.dumps(encode(value))
+
+
+def decode_value(encoded):
+    """
+    Decode a result encoded by encode_value.
+    :param encoded: JSON string
+    :return: the result
+    """
+    def decode(item):
+        if isinstance(item, list):
+            return [decode(element) for element in item]
+        elif isinstance(item, dict):
+            if '__ndarray__' in item:
+                return np.load(io.BytesIO(base64.b64decode(item['__ndarray__'])), allow_pickle=False)
+            elif '__tuple__' in item:
+                return tuple(decode(element) for element in item['__tuple__'])
+            return {decode(key): decode(element) for key, element in item['__dict__']}
+        return item
+
+    return decode(json.loads(encoded))
+
+
+def _make_private_directory(directory):
+    # create directory readable and writable only by the current user, refusing one that others can write to
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        status = os.stat(directory)
+        if status.st_uid != os.getuid():
+            raise PermissionError('%s is not owned by the current user' % directory)
+        if status.st_mode & 0o077:
+            os.chmod(directory, 0o700)
+
+
+class ResultCache:
+    # A size-bounded cache of computation results stored in an SQLite file, with least recently used eviction and
+    # expiry of entries older than ttl seconds. Keys include the model version, so that results cached before a
+    # deployment changing the model are not served after it.
+
+    def __init__(self, path=RESULT_CACHE_PATH, max_entries=RESULT_CACHE_MAX_ENTRIES, ttl=RESULT_CACHE_TTL,
+                 version=None, table='results'):
+        """
+
+        :param path: path of the SQLite file, None or '' disables the cache
+        :param max_entries: maximum number of cached results
+        :param ttl: time in seconds after which a cached result expires
+        :param version: model version included in the keys, by default model_version()
+        :param table: name of the SQLite table, caches in the same file with different tables have separate limits
+        """
+        if not table.isidentifier():
+            raise ValueError('invalid table name %r' % table)
+
+        self.path = path or None
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version = version if version is not None else model_version()
+        self.table = table
+
+        if self.path is not None and os.path.dirname(self.path) == DEFAULT_RESULT_CACHE_DIRECTORY:
+            _make_private_directory(DEFAULT_RESULT_CACHE_DIRECTORY)
+
+        if self.path is not None:
+            with closing(self._connect()) as connection, connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value BLOB, '
+                                   'created REAL, accessed REAL)' % self.table)
+                connection.execute('CREATE INDEX IF NOT EXISTS %s_accessed ON %s (accessed)'
+                                   % (self.table, self.table))
+
+    def _connect(self):
+        # a new connection per operation, connections can not be shared with forked worker processes
+        return sqlite3.connect(self.path, timeout=30)
+
+    def make_key(self, namespace, inputs):
+        return json.dumps([namespace, normalize_inputs(inputs), self.version])
+
+    def get(self, namespace, inputs):
+        """
+        Get a cached result.
+        :param namespace: name of the cached computation
+        :param inputs: inputs of the computation
+        :return: the cached result, or None if it is not cached or has expired
+        """
+        if self.path is None:
+            return None
+
+        key = self.make_key(namespace, inputs)
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            row = connection.execute('SELECT value FROM %s WHERE key = ? AND created > ?' % self.table,
+                                     (key, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE %s SET accessed = ? WHERE key = ?' % self.table, (now, key))
+
+        try:
+            return decode_value(row[0])
+        except ValueError:
+            # e.g. an entry written in an older format
+            return None
+
+    def set(self, namespace, inputs, value):
+        """
+        Store a result, evicting expired and least recently used results beyond max_entries.
+        :param namespace: name of the cached computation
+        :param inputs: inputs of the computation
+        :param value: the result, made of numbers, strings, numpy arrays, lists, tuples and dictionaries, see
+                      encode_value
+        """
+        if self.path is None:
+            return
+
+        key = self.make_key(namespace, inputs)
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            connection.execute('INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?)' % self.table,
+                               (key, encode_value(value), now, now))
+            connection.execute('DELETE FROM %s WHERE created <= ?' % self.table, (now - self.ttl,))
+            connection.execute('DELETE FROM %s WHERE key IN (SELECT key FROM %s ORDER BY accessed DESC '
+                               'LIMIT -1 OFFSET ?)' % (self.table, self.table), (self.max_entries,))
+
+    def get_or_compute(self, namespace, inputs, compute):
+        """
+        Get a cached result, or compute and cache it.
+        :param namespace: name of the cached computation
+        :param inputs: inputs of the computation, used as the cache key
+        :param compute: function without arguments computing the result
+        :return: the result
+        """
+        value = self.get(namespace, inputs)
+        if value is None:
+            value = compute()
+            self.set(namespace, inputs, value)
+        return value
+
+
+result_cache = ResultCache()
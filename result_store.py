@@ -0,0 +1,103 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from result_cache import model_version, normalize_inputs
+
+# results are kept across restarts in a directory of .npz files, one per result. Keys include a hash of the model
+# source files, so results of a changed model are never reused. The store has no size limit and is meant to be
+# read-mostly: it is filled offline (see sweep_runner.publish_sweep and optimize_amplification) and committed with the
+# app, which is deployed from git (see README.md), so that a new deployment starts warm, while results of live requests
+# go to the bounded result_cache. Setting RESULT_STORE_PATH to an empty string disables the store.
+RESULT_STORE_PATH = os.environ.get('RESULT_STORE_PATH',
+                                   os.path.join(os.path.dirname(os.path.abspath(__file__)), 'result_store'))
+
+
+class ResultStore:
+    # A persistent content-addressed store of results made of numbers and numeric arrays, e.g. the tuples returned
+    # by perform_simulation. Results are saved as .npz files (no pickles) named by a hash of the namespace, the
+    # normalized inputs and the model version, and never expire.
+
+    def __init__(self, path=RESULT_STORE_PATH, version=None):
+        """
+
+        :param path: directory of the store, None or '' disables the store
+        :param version: model version included in the keys, by default model_version()
+        """
+        self.path = path or None
+        self.version = version if version is not None else model_version()
+
+    def make_key(self, namespace, inputs):
+        return hashlib.sha256(json.dumps([namespace, normalize_inputs(inputs), self.version]).encode()).hexdigest()
+
+    def _file_path(self, namespace, inputs):
+        key = self.make_key(namespace, inputs)
+        return os.path.join(self.path, namespace, key[:2], key + '.npz')
+
+    def get(self, namespace, inputs):
+        """
+        Get a stored result.
+        :param namespace: name of the computation
+        :param inputs: inputs of the computation
+        :return: tuple of the stored values, numbers for scalars and arrays otherwise, or None if it is not stored
+        """
+        if self.path is None:
+            return None
+
+        try:
+            with np.load(self._file_path(namespace, inputs), allow_pickle=False) as stored:
+                values = [stored['arr_%d' % i] for i in range(len(stored.files))]
+        except FileNotFoundError:
+            return None
+
+        return tuple(value.item() if value.ndim == 0 else value for value in values)
+
+    def set(self, namespace, inputs, value):
+        """
+        Store a result.
+        :param namespace: name of the computation
+        :param inputs: inputs of the computation
+        :param value: tuple of numbers and numeric arrays (or lists)
+        """
+        if self.path is None:
+            return
+
+        arrays = [np.asarray(item) for item in value]
+        for array in arrays:
+            if array.dtype.hasobject:
+                raise ValueError('ResultStore only stores numbers and numeric arrays')
+
+        # written to a temporary file and renamed, readers in other processes never see a partial file
+        file_path = self._file_path(namespace, inputs)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez(buffer, *arrays)
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(buffer.getvalue())
+            os.replace(temporary_path, file_path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def get_or_compute(self, namespace, inputs, compute):
+        """
+        Get a stored result, or compute and store it.
+        :param namespace: name of the computation
+        :param inputs: inputs of the computation, used as the key
+        :param compute: function without arguments computing the result
+        :return: the result
+        """
+        value = self.get(namespace, inputs)
+        if value is None:
+            value = compute()
+            self.set(namespace, inputs, value)
+        return value
+
+
+result_store = ResultStore()
@@ -1,5 +1,4 @@
 from liquidity_pool import LiquidityPool
-from copy import deepcopy
 import numpy as np
 
 
@@ -7,9 +6,6 @@ def perform_simulation(a1=85, a2=0.0001):
 
     def compute_prices(lps, payment_token_label, requested_token_label, reverse_slippage=False):
 
-        # copy to prevent side-effects outside the function
-        lps = [deepcopy(lp) for lp in lps]
-
         n_pricing_methods = len(lps)
         num_tokens = len(token_labels)
         totals = np.zeros((n_pricing_methods, n_purchases))
@@ -20,23 +16,20 @@ def perform_simulation(a1=85, a2=0.0001):
         amplifications = np.zeros((n_pricing_methods, n_purchases))
         price_slippages = np.zeros((n_pricing_methods, n_purchases))
 
-        total = 0
-        for i in range(n_purchases):
-            total += purchase_each_time
-            for p in range(n_pricing_methods):
-                totals[p, i] = total
-                price_slippages[p, i] = lps[p].get_price_slippage(payment_token_label=payment_token_label,
-                                                                  requested_token_label=requested_token_label,
-                                                                  payment_token_amount=purchase_each_time,
-                                                                  reverse_slippage=reverse_slippage)
-                received_amounts[p, i] = lps[p].exchange(payment_token_label=payment_token_label,
-                                                         requested_token_label=requested_token_label,
-                                                         payment_token_amount=purchase_each_time)
-                prices[p, i] = lps[p].get_price(payment_token_label=payment_token_label,
-                                                requested_token_label=requested_token_label)
-                Ds[p, i] = lps[p].get_D()
-                amplifications[p, i] = lps[p].get_last_amplification()
-                token_amounts[p, i] = lps[p]._token_amounts
+        purchase_amounts = np.full(n_purchases, purchase_each_time, dtype=np.float64)
+        for p in range(n_pricing_methods):
+            # clone to prevent side-effects outside the function
+            path = lps[p].clone().simulate_path(payment_token_label=payment_token_label,
+                                                requested_token_label=requested_token_label,
+                                                payment_token_amounts=purchase_amounts,
+                                                reverse_slippage=reverse_slippage)
+            totals[p] = np.cumsum(purchase_amounts)
+            price_slippages[p] = path['slippage']
+            received_amounts[p] = path['received_amount']
+            prices[p] = path['price']
+            Ds[p] = path['D']
+            amplifications[p] = path['amplification']
+            token_amounts[p] = path['token_amounts']
 
         return totals, prices, received_amounts, Ds, amplifications, token_amounts, price_slippages
 
@@ -0,0 +1,201 @@
+import os
+import threading
+import time
+import traceback
+import uuid
+
+import numpy as np
+
+from pool_pair_price import UNISWAP_LIQUITY_RATIOS, compute_routed_market_cap_saved, final_price_if_all_uniswap, \
+    iterate_market_cap_sweep
+from metrics import latency_metrics
+from result_cache import ResultCache, result_cache
+
+JOB_NAMESPACE = 'market_cap_sweep_job'
+CANCELLED_JOB_NAMESPACE = 'market_cap_sweep_job_cancelled'
+JOB_TTL = 10 * 60  # seconds after its last update that a job is dropped
+JOB_MAX_ENTRIES = 1000  # job states kept in the shared job table, separately from the cached results
+JOB_TABLE = 'sweep_jobs'
+
+
+class _ProcessLocalStore:
+    # stand-in for the job table when the result cache is disabled. Jobs are then only visible to the server process
+    # running them, so a deployment with several server workers (e.g. gunicorn with WEB_CONCURRENCY > 1) needs the
+    # shared result cache. Entries not updated for ttl seconds, i.e. finished, cancelled or abandoned jobs, are dropped.
+
+    def __init__(self, ttl=JOB_TTL):
+        self.ttl = ttl
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, namespace, inputs):
+        with self._lock:
+            value, _ = self._values.get((namespace, tuple(inputs)), (None, None))
+            return value
+
+    def set(self, namespace, inputs, value):
+        now = time.time()
+        with self._lock:
+            self._values = {key: (old_value, updated) for key, (old_value, updated) in self._values.items()
+                            if updated > now - self.ttl}
+            self._values[(namespace, tuple(inputs))] = (value, now)
+
+
+def market_cap_results(progress, boot_total_token_num):
+    """
+    Assemble the points of a sweep job finished so far into results in the format of compute_market_cap_saved.
+    :param progress: progress of the job, see MarketCapSweepJobs.get_progress
+    :param boot_total_token_num: circulating token supply
+    :return: results of compute_market_cap_saved restricted to the finished points, in liquidity ratio order
+    """
+    indices = sorted(progress['points'])
+    points = [progress['points'][index] for index in indices]
+
+    final_prices_for_liquidity_ratio = np.array([final_price for final_price, _, _ in points])
+    market_cap_saved = (final_prices_for_liquidity_ratio - progress['price_if_all_uniswap']) * boot_total_token_num
+
+    return market_cap_saved, final_prices_for_liquidity_ratio, UNISWAP_LIQUITY_RATIOS[indices], \
+        progress['price_if_all_uniswap'], [arb_drain for _, arb_drain, _ in points], \
+        [effective_large_sell_price for _, _, effective_large_sell_price in points]
+
+
+def stored_market_cap_results(stored, boot_total_token_num):
+    """
+    Turn a complete sweep stored in the result store as 'market_cap_sweep' into results in the format of
+    compute_market_cap_saved. The stored sweep does not depend on the circulating supply.
+    :param stored: final prices, arb drains and effective large sell prices for UNISWAP_LIQUITY_RATIOS, and the
+                   final price if all the liquidity is in Uniswap
+    :param boot_total_token_num: circulating token supply
+    :return: results of compute_market_cap_saved
+    """
+    final_prices_for_liquidity_ratio, arb_drains, effective_large_sell_prices, price_if_all_uniswap = stored
+    market_cap_saved = (final_prices_for_liquidity_ratio - price_if_all_uniswap) * boot_total_token_num
+
+    return market_cap_saved, final_prices_for_liquidity_ratio, UNISWAP_LIQUITY_RATIOS, price_if_all_uniswap, \
+        list(arb_drains), list(effective_large_sell_prices)
+
+
+class MarketCapSweepJobs:
+    # Market cap sweeps running in background threads, publishing each finished liquidity ratio point. Progress and
+    # cancellation go through a table of the shared result cache file, so any server worker can poll or cancel a job.
+    # The table has its own size limit, job updates never evict cached results.
+
+    def __init__(self, store=None):
+        """
+
+        :param store: store with the get/set interface of ResultCache, by default the JOB_TABLE table of the shared
+                      result cache file
+        """
+        if store is None:
+            if result_cache.path is not None:
+                store = ResultCache(result_cache.path, max_entries=JOB_MAX_ENTRIES, ttl=JOB_TTL,
+                                    version=result_cache.version, table=JOB_TABLE)
+            else:
+                if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1:
+                    print('The result cache is disabled, market cap sweep jobs can only be polled by the server '
+                          'worker running them. Enable RESULT_CACHE_PATH with several server workers.')
+                store = _ProcessLocalStore()
+        self.store = store
+        self._finished = {}  # job id -> event set when the job, running in this process, is done
+
+    def start(self, boot_total_token_num, result_key=None, routed_key=None, run_sweep=True, **sweep_kwargs):
+        """
+        Start a sweep in a background thread.
+        :param boot_total_token_num: circulating token supply
+        :param result_key: optional key under which the complete results are stored in the result cache as
+                           'compute_market_cap_saved'
+        :param routed_key: optional key of the results of compute_routed_market_cap_saved for the same inputs, which
+                           are then computed first (or taken from the result cache) and published with the progress
+        :param run_sweep: False to only compute the routed results, e.g. when the sweep results are already known
+        :param sweep_kwargs: arguments of pool_pair_price.iterate_market_cap_sweep
+        :return: id of the job
+        """
+        job_id = uuid.uuid4().hex
+        self.store.set(JOB_NAMESPACE, [job_id], {'points': {}, 'price_if_all_uniswap': None, 'routed_results': None,
+                                                 'error': None, 'done': False})
+        self._finished[job_id] = threading.Event()
+        threading.Thread(target=self._run,
+                         args=(job_id, boot_total_token_num, result_key, routed_key, run_sweep, sweep_kwargs),
+                         daemon=True).start()
+        return job_id
+
+    def cancel(self, job_id):
+        # the job stops before its next point
+        self.store.set(CANCELLED_JOB_NAMESPACE, [job_id], True)
+
+    def get_progress(self, job_id):
+        """
+        Get the progress of a job.
+        :param job_id: id of the job
+        :return: dictionary with 'points' (liquidity ratio index -> (final price, arb drain, effective large sell
+                 price)), 'price_if_all_uniswap', 'routed_results', 'error' (message if the job failed, it is then
+                 done) and 'done', or None if the job is unknown
+        """
+        return self.store.get(JOB_NAMESPACE, [job_id])
+
+    def wait(self, job_id, timeout):
+        """
+        Wait for a job started by this process to be done, e.g. to answer a fast sweep without polling it.
+        :param job_id: id of the job
+        :param timeout: maximum time to wait in seconds
+        :return: the progress of the job, see get_progress, which is not done if the timeout expired
+        """
+        finished = self._finished.get(job_id)
+        if finished is not None:
+            finished.wait(timeout)
+        return self.get_progress(job_id)
+
+    def _run(self, job_id, boot_total_token_num, result_key, routed_key, run_sweep, sweep_kwargs):
+        progress = {'points': {}, 'price_if_all_uniswap': None, 'routed_results': None, 'error': None,
+                    'done': False}
+        try:
+            # the simulation time of the market cap page, which no longer runs in its callbacks
+            with latency_metrics.timed('page_mcap.sweep_job'):
+                self._run_sweep(job_id, boot_total_token_num, result_key, routed_key, run_sweep, sweep_kwargs,
+                                progress)
+        except Exception as e:
+            # a failed job is done, so that pollers stop and show the error
+            traceback.print_exc()
+            progress['error'] = '%s: %s' % (type(e).__name__, e)
+            progress['done'] = True
+            self.store.set(JOB_NAMESPACE, [job_id], progress)
+        finally:
+            self._finished.pop(job_id).set()
+
+    def _run_sweep(self, job_id, boot_total_token_num, result_key, routed_key, run_sweep, sweep_kwargs, progress):
+        large_sell_ratio = float(sweep_kwargs.get('large_sell_ratio', 0.1))
+
+        # the routed results are a single batched solve, they come first
+        if routed_key is not None:
+            progress['routed_results'] = result_cache.get_or_compute(
+                'compute_routed_market_cap_saved', routed_key,
+                lambda: compute_routed_market_cap_saved(boot_total_token_num, large_sell_ratio=large_sell_ratio,
+                                                        boot_pool_token_num=sweep_kwargs.get('boot_pool_token_num',
+                                                                                             1000000),
+                                                        amplification=sweep_kwargs.get('amplification')))
+            self.store.set(JOB_NAMESPACE, [job_id], progress)
+
+        if run_sweep:
+            # the baseline comes next, every published point can then be turned into market cap saved
+            progress['price_if_all_uniswap'] = final_price_if_all_uniswap(large_sell_ratio,
+                                                                          sweep_kwargs.get('arb_method', 'optimal'))
+
+            sweep = iterate_market_cap_sweep(**sweep_kwargs)
+            try:
+                for index, point in sweep:
+                    if self.store.get(CANCELLED_JOB_NAMESPACE, [job_id]):
+                        return
+                    progress['points'][index] = point
+                    self.store.set(JOB_NAMESPACE, [job_id], progress)
+            finally:
+                sweep.close()
+
+        progress['done'] = True
+        self.store.set(JOB_NAMESPACE, [job_id], progress)
+
+        if run_sweep and result_key is not None:
+            result_cache.set('compute_market_cap_saved', result_key,
+                             market_cap_results(progress, boot_total_token_num))
+
+
+market_cap_sweep_jobs = MarketCapSweepJobs()
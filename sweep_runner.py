@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from pool_pair_price import UNISWAP_LIQUITY_RATIOS, final_price_for_liquidity_ratio, final_price_if_all_uniswap
+from result_store import model_version, result_store
+from simulation import perform_simulation
+
+INDEX_FILE = 'index.json'
+DONE_FILE = 'done.npy'
+DEFAULT_CHUNK_SIZE = 64  # cells per worker task
+
+SIMULATION_OUTPUTS = ('prices1', 'prices2', 'price_slippages1', 'price_slippages2', 'token_ratio1', 'token_ratio2',
+                      'amplifications1', 'amplifications2')
+
+
+def _market_cap_cell(a1, a2, large_sell_ratio, boot_pool_token_num, uniswap_liquity_ratio,
+                     amplification_transition_ratio, arb_method):
+    # one point of the compute_market_cap_saved sweep
+    return final_price_for_liquidity_ratio(uniswap_liquity_ratio, large_sell_ratio=large_sell_ratio,
+                                           boot_token_num=boot_pool_token_num, amplification=[a1, a2],
+                                           arb_method=arb_method,
+                                           amplification_transition_ratio=amplification_transition_ratio)
+
+
+def _simulation_cell(a1, a2):
+    return perform_simulation(a1=a1, a2=a2)
+
+
+# model name -> (function computing one cell, default parameters, names of the outputs returned by the function).
+# Parameters in the grid spec are swept, the others take the values of 'fixed' in the spec or these defaults.
+SWEEP_MODELS = {
+    'market_cap': (_market_cap_cell,
+                   {'a1': 85, 'a2': 0.0001, 'large_sell_ratio': 0.1, 'boot_pool_token_num': 1000000,
+                    'uniswap_liquity_ratio': 0.5, 'amplification_transition_ratio': 1, 'arb_method': 'optimal'},
+                   ('final_price', 'arb_drain', 'effective_large_sell_price')),
+    'simulation': (_simulation_cell, {'a1': 85, 'a2': 0.0001}, SIMULATION_OUTPUTS),
+}
+
+
+def parameter_values(spec):
+    """
+    Values of a swept parameter.
+    :param spec: list of values, or dictionary with 'start', 'stop', 'num' and optionally 'log' (values evenly
+                 spaced in log10)
+    :return: array of the values
+    """
+    if isinstance(spec, dict):
+        if spec.get('log', False):
+            return np.logspace(np.log10(spec['start']), np.log10(spec['stop']), spec['num'])
+        return np.linspace(spec['start'], spec['stop'], spec['num'])
+    return np.asarray(spec, dtype=np.float64)
+
+
+def make_grid(grid_spec):
+    """
+    Resolve a grid spec.
+    :param grid_spec: dictionary with 'model' (name in SWEEP_MODELS), 'parameters' (parameter name -> values, see
+                      parameter_values) and optionally 'fixed' (parameter name -> value). A market_cap grid without
+                      uniswap_liquity_ratio sweeps UNISWAP_LIQUITY_RATIOS, as compute_market_cap_saved does.
+    :return: model name, dictionary of swept parameter name -> array of values in axis order, dictionary of fixed
+             parameters
+    """
+    model = grid_spec['model']
+    if model not in SWEEP_MODELS:
+        raise ValueError('Unknown sweep model %s, expected one of %s' % (model, sorted(SWEEP_MODELS)))
+    _, defaults, _ = SWEEP_MODELS[model]
+
+    axes = {name: parameter_values(values) for name, values in grid_spec['parameters'].items()}
+    if model == 'market_cap' and 'uniswap_liquity_ratio' not in axes:
+        axes['uniswap_liquity_ratio'] = UNISWAP_LIQUITY_RATIOS
+
+    fixed = dict(defaults)
+    fixed.update(grid_spec.get('fixed', {}))
+    unknown = (set(axes) | set(fixed)) - set(defaults)
+    if unknown:
+        raise ValueError('Unknown parameters %s for sweep model %s' % (sorted(unknown), model))
+    for name in axes:
+        del fixed[name]
+
+    return model, axes, fixed
+
+
+def _compute_cells(model, axes, fixed, flat_indices):
+    # compute a block of cells in a worker process, returns the flat indices and an array per output
+    function, _, outputs = SWEEP_MODELS[model]
+    grid_shape = tuple(len(values) for values in axes.values())
+    cell_indices = np.unravel_index(flat_indices, grid_shape)
+
+    results = []
+    for i in range(len(flat_indices)):
+        parameters = dict(fixed)
+        for (name, values), axis_indices in zip(axes.items(), cell_indices):
+            parameters[name] = float(values[axis_indices[i]])
+        results.append(function(**parameters))
+
+    return flat_indices, {name: np.array([result[o] for result in results], dtype=np.float64)
+                          for o, name in enumerate(outputs)}
+
+
+def _create_outputs(directory, model, axes, fixed):
+    # preallocate the output arrays, filled with NaN, and write the index. Output shapes come from the first cell,
+    # which is stored as completed.
+    _, first_cell = _compute_cells(model, axes, fixed, np.array([0]))
+    grid_shape = tuple(len(values) for values in axes.values())
+
+    os.makedirs(directory, exist_ok=True)
+    for name, values in first_cell.items():
+        output = np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=np.float64,
+                                           shape=grid_shape + values.shape[1:])
+        output[...] = np.nan
+        output.reshape((-1,) + values.shape[1:])[0] = values[0]
+        output.flush()
+        del output
+    done = np.lib.format.open_memmap(os.path.join(directory, DONE_FILE), mode='w+', dtype=np.bool_,
+                                     shape=grid_shape)
+    done.reshape(-1)[0] = True
+    done.flush()
+    del done
+
+    # the index is written last, a directory without it is an incomplete setup and is set up again
+    index = {'model': model, 'parameters': {name: values.tolist() for name, values in axes.items()},
+             'fixed': fixed, 'shape': list(grid_shape), 'outputs': list(first_cell), 'model_version': model_version(),
+             'created': time.time()}
+    with open(os.path.join(directory, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=1)
+
+
+def run_sweep(grid_spec, directory, max_workers=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """
+    Compute a parameter grid on worker processes, writing each output into a memory-mapped .npy array of the grid
+    shape (plus the output shape) as cells finish. Only blocks of cells being computed are held in memory. Cells
+    are marked in done.npy once their results are written, so running the same grid spec into the same directory
+    again resumes an interrupted sweep, skipping the completed cells, as long as the model has not changed.
+    :param grid_spec: grid spec, see make_grid
+    :param directory: output directory with index.json, done.npy and a <output>.npy file per model output
+    :param max_workers: number of worker processes, None uses all CPUs
+    :param chunk_size: number of cells per worker task
+    :param progress: optional function called with (completed cells, total cells) after each task
+    :return: number of cells computed by this call
+    """
+    model, axes, fixed = make_grid(grid_spec)
+
+    index_path = os.path.join(directory, INDEX_FILE)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index['model'] != model or index['fixed'] != fixed or \
+                index['parameters'] != {name: values.tolist() for name, values in axes.items()}:
+            raise ValueError('%s holds a sweep of a different grid' % directory)
+        if index['model_version'] != model_version():
+            raise ValueError('%s holds a sweep computed with a different model version' % directory)
+    else:
+        _create_outputs(directory, model, axes, fixed)
+        with open(index_path) as f:
+            index = json.load(f)
+
+    outputs = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r+') for name in index['outputs']}
+    done = np.load(os.path.join(directory, DONE_FILE), mmap_mode='r+')
+    flat_outputs = {name: output.reshape((done.size,) + output.shape[done.ndim:]) for name, output in outputs.items()}
+    flat_done = done.reshape(-1)
+
+    pending = np.flatnonzero(~flat_done)
+    n_completed = done.size - len(pending)
+    n_computed = 0
+
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    # a bounded number of tasks is in flight, so that grids of millions of cells are not submitted at once
+    max_in_flight = 2 * max_workers
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        chunks = (pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size))
+        futures = set()
+        try:
+            while True:
+                for flat_indices in chunks:
+                    futures.add(executor.submit(_compute_cells, model, axes, fixed, flat_indices))
+                    if len(futures) >= max_in_flight:
+                        break
+                if not futures:
+                    break
+
+                finished, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    flat_indices, results = future.result()
+                    for name, values in results.items():
+                        flat_outputs[name][flat_indices] = values
+                        outputs[name].flush()
+                    # results are on disk before the cells are marked as done
+                    flat_done[flat_indices] = True
+                    done.flush()
+
+                    n_computed += len(flat_indices)
+                    if progress is not None:
+                        progress(n_completed + n_computed, done.size)
+        finally:
+            for future in futures:
+                future.cancel()
+
+    return n_computed
+
+
+def load_sweep(directory):
+    """
+    Load a sweep written by run_sweep, memory-mapped, possibly while it is still running.
+    :param directory: output directory of run_sweep
+    :return: index dictionary (model, parameters with the values of each grid axis in axis order, fixed parameters,
+             shape, outputs), dictionary of output name -> array, boolean array of the completed cells
+    """
+    with open(os.path.join(directory, INDEX_FILE)) as f:
+        index = json.load(f)
+
+    outputs = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in index['outputs']}
+    return index, outputs, np.load(os.path.join(directory, DONE_FILE), mmap_mode='r')
+
+
+def publish_sweep(directory, store=result_store):
+    """
+    Copy the completed results of a sweep into the result store under the keys used by the pages, so that the pages
+    answer those inputs without computing them. A simulation sweep gives 'perform_simulation' results per (A1, A2)
+    cell. A market_cap sweep over the liquidity ratios of compute_market_cap_saved, with the default transition ratio
+    and arbitrage method, gives a 'market_cap_sweep' result per (A1, A2, sell ratio, pool size) cell whose liquidity
+    ratios are all completed.
+    :param directory: output directory of run_sweep
+    :param store: result store, by default the store of the pages
+    :return: number of results stored
+    """
+    index, outputs, done = load_sweep(directory)
+    if index['model_version'] != store.version:
+        raise ValueError('%s holds a sweep computed with a different model version' % directory)
+
+    names = list(index['parameters'])
+    fixed = index['fixed']
+    if index['model'] == 'market_cap':
+        if 'uniswap_liquity_ratio' not in names or \
+                not np.array_equal(index['parameters']['uniswap_liquity_ratio'], UNISWAP_LIQUITY_RATIOS) or \
+                fixed.get('amplification_transition_ratio') != 1 or fixed.get('arb_method') != 'optimal':
+            raise ValueError('%s does not hold sweeps of compute_market_cap_saved' % directory)
+        # results are complete cells of the other parameters, the liquidity ratio becomes the last axis
+        ratio_axis = names.index('uniswap_liquity_ratio')
+        outputs = {name: np.moveaxis(output, ratio_axis, -1) for name, output in outputs.items()}
+        done = np.moveaxis(done, ratio_axis, -1).all(axis=-1)
+        del names[ratio_axis]
+
+    n_published = 0
+    for cell in map(tuple, np.argwhere(done)):
+        parameters = dict(fixed)
+        parameters.update({name: index['parameters'][name][i] for name, i in zip(names, cell)})
+        if index['model'] == 'market_cap':
+            price_if_all_uniswap = final_price_if_all_uniswap(float(parameters['large_sell_ratio']), 'optimal')
+            store.set('market_cap_sweep', [parameters['a1'], parameters['a2'], parameters['large_sell_ratio'],
+                                           parameters['boot_pool_token_num']],
+                      (outputs['final_price'][cell], outputs['arb_drain'][cell],
+                       outputs['effective_large_sell_price'][cell], price_if_all_uniswap))
+        else:
+            store.set('perform_simulation', [parameters['a1'], parameters['a2']],
+                      tuple(outputs[name][cell] for name in SIMULATION_OUTPUTS))
+        n_published += 1
+
+    return n_published
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a parameter sweep of the market cap or price simulation into '
+                                                 'memory-mapped arrays, resuming an interrupted sweep.')
+    parser.add_argument('grid_spec', help='path of a JSON grid spec file, or the grid spec itself, e.g. {"model": '
+                                          '"market_cap", "parameters": {"a1": {"start": 1, "stop": 200, "num": 20, '
+                                          '"log": true}, "a2": [0.0001, 0.01]}}')
+    parser.add_argument('output', help='output directory')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='cells per worker task')
+    parser.add_argument('--publish', action='store_true', help='copy the results into the result store of the pages')
+    args = parser.parse_args()
+
+    if os.path.isfile(args.grid_spec):
+        with open(args.grid_spec) as f:
+            grid_spec = json.load(f)
+    else:
+        grid_spec = json.loads(args.grid_spec)
+
+    last_report = [0.0]
+
+    def report(n_completed, n_cells):
+        if time.time() - last_report[0] > 5 or n_completed == n_cells:
+            last_report[0] = time.time()
+            print('%d of %d cells completed' % (n_completed, n_cells), flush=True)
+
+    n_computed = run_sweep(grid_spec, args.output, max_workers=args.workers, chunk_size=args.chunk_size,
+                           progress=report)
+    print('computed %d cells into %s' % (n_computed, args.output))
+
+    if args.publish:
+        print('stored %d results in %s' % (publish_sweep(args.output), result_store.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# Equivalence checks of the optimized numerics against simpler reference computations: batched vs scalar solvers,
+# compiled vs Python kernels, PoolBatch vs LiquidityPool, the router vs a brute-force split search, and resumed vs
+# fresh sweeps and replays. Run with `python -m pytest`.
+
+import numpy as np
+import pytest
+
+import jit_kernels
+import utils as ut
+from liquidity_pool import LiquidityPool
+from pool_batch import PoolBatch
+from pool_pair_price import _arb_price_gap, find_arb_trade_boot_num, route_sell
+from sweep_runner import DONE_FILE, load_sweep, run_sweep
+from trade_replay import make_replay_pools, read_swap_log_columns, replay_swaps, write_swap_log_columns
+
+AMPLIFICATIONS = [0.0001, 1, 85, 200]
+
+
+def _random_pools(rng, n_states, n_coins):
+    return rng.uniform(1e3, 1e6, (n_states, n_coins))
+
+
+def _make_pool(pricing_method, token_amounts, fee_ratio=0):
+    labels = ['Boot', 'USDC', 'DAI', 'USDT'][:len(token_amounts)]
+    if pricing_method == 'uniswap':
+        return LiquidityPool(labels, token_amounts, fee_ratio=fee_ratio, pricing_method='uniswap')
+    elif pricing_method == 'stableswap':
+        return LiquidityPool(labels, token_amounts, fee_ratio=fee_ratio, pricing_method='stableswap',
+                             amplification=85)
+    return LiquidityPool(labels, token_amounts, fee_ratio=fee_ratio, pricing_method='customswap',
+                         amplification=[85, 0.0001], promoted_token_label='Boot')
+
+
+@pytest.mark.parametrize('n_coins', [2, 3])
+@pytest.mark.parametrize('amp', AMPLIFICATIONS)
+def test_batch_solvers_match_scalar_solvers(n_coins, amp):
+    x = _random_pools(np.random.default_rng(0), 20, n_coins)
+    payment_token_amounts_after = x[:, 0] * 1.5
+
+    D = ut.curve_get_D_batch(x, amp)
+    np.testing.assert_allclose(D, [ut.curve_get_D(row, amp) for row in x], rtol=1e-9)
+
+    y = ut.curve_get_y_batch(0, 1, payment_token_amounts_after, x, amp, D=D)
+    np.testing.assert_allclose(y, [ut.curve_get_y(0, 1, after, row, amp, D=row_D)
+                                   for after, row, row_D in zip(payment_token_amounts_after, x, D)], rtol=1e-9)
+
+    prices = ut.curve_get_spot_price_batch(1, 0, x, amp, D=D)
+    np.testing.assert_allclose(prices, [ut.curve_get_spot_price(1, 0, row, amp, D=row_D) for row, row_D in zip(x, D)],
+                               rtol=1e-9)
+
+
+@pytest.mark.parametrize('pricing_method', ['uniswap', 'stableswap', 'customswap'])
+@pytest.mark.parametrize('token_amounts', [[50000, 50000], [20000, 80000], [90000, 10000], [30000, 50000, 70000]])
+def test_spot_price_matches_small_trade_price(pricing_method, token_amounts):
+    # the analytic marginal price is the limit of the price of ever smaller trades
+    pool = _make_pool(pricing_method, token_amounts)
+    spot_price = pool.get_price('USDC', 'Boot')
+    small_trade_price = pool.get_price('USDC', 'Boot', payment_token_amount=1e-3 * token_amounts[1])
+    assert spot_price == pytest.approx(small_trade_price, rel=1e-3)
+
+
+@pytest.mark.parametrize('pricing_method', ['uniswap', 'stableswap', 'customswap'])
+def test_exchange_keeps_the_invariant(pricing_method):
+    # swaps without fee keep x * y for uniswap and D of the amplification used for the other pools
+    pool = _make_pool(pricing_method, [30000, 50000, 70000] if pricing_method != 'uniswap' else [30000, 50000])
+    pool.get_price('USDC', 'Boot')
+    D_before = ut.uniswap_get_D(pool.get_token_amounts()) if pricing_method == 'uniswap' else \
+        ut.curve_get_D(pool.get_token_amounts(), pool.get_last_amplification())
+
+    pool.exchange('Boot', 'USDC', 2000)
+
+    D_after = ut.uniswap_get_D(pool.get_token_amounts()) if pricing_method == 'uniswap' else \
+        ut.curve_get_D(pool.get_token_amounts(), pool.get_last_amplification())
+    assert D_after == pytest.approx(D_before, rel=1e-9)
+
+
+def test_arbitrage_trade_closes_the_price_gap():
+    lp_uniswap = _make_pool('uniswap', [50000, 50000])
+    lp_customswap = _make_pool('customswap', [50000, 50000])
+    lp_uniswap.exchange('Boot', 'USDC', 10000)
+
+    arb_trade_boot_num = find_arb_trade_boot_num(lp_customswap, lp_uniswap, arb_price_tolerance=0.03)
+
+    # the smallest trade bringing the gap within tolerance, found by bisection
+    assert _arb_price_gap(lp_customswap, lp_uniswap, arb_trade_boot_num) <= 0.03
+    assert _arb_price_gap(lp_customswap, lp_uniswap, arb_trade_boot_num * (1 - 1e-6)) > 0.03
+    # the pools are left unchanged
+    np.testing.assert_array_equal(lp_uniswap.get_token_amounts(), [60000, 50000 - 50000 * 10000 / 60000])
+
+
+@pytest.mark.skipif(jit_kernels.numba is None, reason='numba is not installed')
+def test_jit_kernels_match_python():
+    assert jit_kernels.check_equivalence(n_cases=50) < 1e-12
+
+
+@pytest.mark.parametrize('pricing_method', ['uniswap', 'stableswap', 'customswap'])
+@pytest.mark.parametrize('fee_ratio', [0, 0.003])
+def test_pool_batch_matches_liquidity_pool(pricing_method, fee_ratio):
+    # trades large enough to switch the customswap amplification back and forth
+    rng = np.random.default_rng(1)
+    n_paths, n_trades = 8, 20
+    pool = _make_pool(pricing_method, [50000, 50000], fee_ratio=fee_ratio)
+    pools = [pool.clone() for _ in range(n_paths)]
+    pool_batch = PoolBatch.from_pool(pool, n_paths)
+
+    for _ in range(n_trades):
+        payment_token_index = int(rng.integers(2))
+        amounts = rng.uniform(100, 10000, n_paths)
+        rows = np.flatnonzero(rng.random(n_paths) < 0.7)
+
+        received = pool_batch.exchange(rows, payment_token_index, 1 - payment_token_index, amounts[rows])
+        np.testing.assert_allclose(received, [pools[row].exchange_by_index(payment_token_index,
+                                                                            1 - payment_token_index, amounts[row])
+                                              for row in rows], rtol=1e-9)
+
+    np.testing.assert_allclose(pool_batch.token_amounts, [p.get_token_amounts() for p in pools], rtol=1e-9)
+    np.testing.assert_allclose(pool_batch.get_price(1, 0), [p.get_price_by_index(1, 0) for p in pools], rtol=1e-9)
+
+
+@pytest.mark.parametrize('sell_amount', [1000, 10000, 40000])
+def test_route_sell_matches_brute_force(sell_amount):
+    lp_uniswap = _make_pool('uniswap', [30000, 30000])
+    lp_customswap = _make_pool('customswap', [70000, 70000])
+
+    _, _, received_amount, _, _ = route_sell(lp_uniswap, lp_customswap, 'Boot', 'USDC', sell_amount)
+
+    best_received_amount = 0
+    for amount_uniswap in np.linspace(0, sell_amount, 401):
+        received = lp_uniswap.clone().exchange('Boot', 'USDC', amount_uniswap) + \
+            lp_customswap.clone().exchange('Boot', 'USDC', sell_amount - amount_uniswap)
+        best_received_amount = max(best_received_amount, received)
+
+    assert received_amount >= best_received_amount * (1 - 1e-9)
+    assert received_amount == pytest.approx(best_received_amount, rel=1e-4)
+
+
+def test_resumed_sweep_matches_fresh_sweep(tmp_path):
+    grid_spec = {'model': 'market_cap', 'parameters': {'a1': [10, 85], 'uniswap_liquity_ratio': [0.3, 0.5, 0.7]},
+                 'fixed': {'boot_pool_token_num': 100000}}
+    run_sweep(grid_spec, tmp_path / 'fresh', max_workers=1, chunk_size=2)
+
+    # an interrupted sweep: some cells are not marked as done and have no results
+    run_sweep(grid_spec, tmp_path / 'resumed', max_workers=1, chunk_size=2)
+    _, outputs, _ = load_sweep(tmp_path / 'resumed')
+    done = np.load(tmp_path / 'resumed' / DONE_FILE, mmap_mode='r+')
+    for output in outputs:
+        output_path = tmp_path / 'resumed' / (output + '.npy')
+        values = np.load(output_path, mmap_mode='r+')
+        values.reshape(-1)[[1, 4]] = np.nan
+        values.flush()
+    done.reshape(-1)[[1, 4]] = False
+    done.flush()
+    del done, values
+
+    assert run_sweep(grid_spec, tmp_path / 'resumed', max_workers=1, chunk_size=2) == 2
+
+    _, fresh_outputs, _ = load_sweep(tmp_path / 'fresh')
+    _, resumed_outputs, resumed_done = load_sweep(tmp_path / 'resumed')
+    assert resumed_done.all()
+    for name in fresh_outputs:
+        np.testing.assert_array_equal(resumed_outputs[name], fresh_outputs[name])
+
+
+def test_chunked_replay_matches_single_chunk(tmp_path):
+    rng = np.random.default_rng(2)
+    n_swaps = 50
+    payment_tokens = rng.integers(2, size=n_swaps)
+    swap_log = {'timestamp': np.arange(n_swaps, dtype=np.float64), 'payment_token': payment_tokens,
+                'requested_token': 1 - payment_tokens, 'payment_token_amount': rng.uniform(10, 2000, n_swaps)}
+
+    def replay(chunks):
+        pools = make_replay_pools(['Boot', 'USDC'], [50000, 50000])
+        return np.concatenate(list(replay_swaps(pools, chunks, 'Boot', 'USDC')))
+
+    single_chunk = replay([swap_log])
+
+    # the log converted to binary columns and read back in uneven chunks
+    write_swap_log_columns(tmp_path, [{name: values[start:start + 13] for name, values in swap_log.items()}
+                                      for start in range(0, n_swaps, 13)])
+    chunked = replay(read_swap_log_columns(tmp_path, chunk_size=7))
+
+    for name in single_chunk.dtype.names:
+        np.testing.assert_array_equal(chunked[name], single_chunk[name])
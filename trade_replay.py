@@ -0,0 +1,274 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+
+import numpy as np
+
+from liquidity_pool import LiquidityPool
+
+# columns of a swap log. In CSV files the token columns hold token labels or indices, in binary column directories
+# (one .npy file per column, read memory-mapped) they hold indices. The timestamp column is optional.
+SWAP_LOG_COLUMNS = {'timestamp': np.float64, 'payment_token': np.int64, 'requested_token': np.int64,
+                    'payment_token_amount': np.float64}
+
+DEFAULT_CHUNK_SIZE = 100000  # swaps read, replayed and written at a time
+
+
+def _token_index(value, token_labels):
+    # token column value of a CSV swap log, a label or an integer index
+    return token_labels.index(value) if value in token_labels else int(value)
+
+
+def read_swap_log_csv(path, token_labels, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read a CSV swap log in chunks. The file has a header row naming the columns of SWAP_LOG_COLUMNS, other columns
+    are ignored.
+    :param path: CSV file
+    :param token_labels: token labels of the pools, used to resolve labels in the token columns
+    :param chunk_size: number of swaps per chunk
+    :return: generator of dictionaries of column name -> array, one per chunk
+    """
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        while True:
+            rows = list(itertools.islice(reader, chunk_size))
+            if not rows:
+                return
+
+            chunk = {'payment_token': np.array([_token_index(row['payment_token'], token_labels) for row in rows]),
+                     'requested_token': np.array([_token_index(row['requested_token'], token_labels)
+                                                  for row in rows]),
+                     'payment_token_amount': np.array([float(row['payment_token_amount']) for row in rows])}
+            if 'timestamp' in reader.fieldnames:
+                chunk['timestamp'] = np.array([float(row['timestamp']) for row in rows])
+            yield chunk
+
+
+def read_swap_log_columns(directory, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read a swap log stored as binary columns in chunks. The columns are memory-mapped, so only the chunk being
+    replayed is loaded.
+    :param directory: directory with a <column>.npy file per column of SWAP_LOG_COLUMNS
+    :param chunk_size: number of swaps per chunk
+    :return: generator of dictionaries of column name -> array, one per chunk
+    """
+    columns = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+               for name in SWAP_LOG_COLUMNS if os.path.exists(os.path.join(directory, name + '.npy'))}
+    n_swaps = len(columns['payment_token_amount'])
+
+    for start in range(0, n_swaps, chunk_size):
+        yield {name: np.array(values[start:start + chunk_size]) for name, values in columns.items()}
+
+
+def write_swap_log_columns(directory, chunks):
+    """
+    Convert a swap log to binary columns, e.g. a CSV log read with read_swap_log_csv, so that it can be replayed
+    repeatedly without parsing it again.
+    :param directory: output directory, created if needed
+    :param chunks: iterable of dictionaries of column name -> array
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    # the columns are appended chunk by chunk as raw data, then given a .npy header once their length is known
+    files = {}
+    n_swaps = 0
+    try:
+        for chunk in chunks:
+            for name, values in chunk.items():
+                if name not in files:
+                    files[name] = open(os.path.join(directory, name + '.raw'), 'wb')
+                np.asarray(values, dtype=SWAP_LOG_COLUMNS[name]).tofile(files[name])
+            n_swaps += len(chunk['payment_token_amount'])
+    finally:
+        for f in files.values():
+            f.close()
+
+    for name in files:
+        raw_path = os.path.join(directory, name + '.raw')
+        column = np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+',
+                                           dtype=SWAP_LOG_COLUMNS[name], shape=(n_swaps,))
+        if n_swaps > 0:
+            # copied in chunks, so that memory use does not depend on the length of the log
+            raw_column = np.memmap(raw_path, dtype=SWAP_LOG_COLUMNS[name], mode='r', shape=(n_swaps,))
+            for start in range(0, n_swaps, DEFAULT_CHUNK_SIZE):
+                column[start:start + DEFAULT_CHUNK_SIZE] = raw_column[start:start + DEFAULT_CHUNK_SIZE]
+            del raw_column
+        column.flush()
+        del column
+        os.remove(raw_path)
+
+
+def make_replay_pools(token_labels, initial_token_amounts, amplification=None, promoted_token_label=None,
+                      fee_ratio=0):
+    """
+    Create a Uniswap, a Stableswap and a Customswap pool with the same tokens, as in simulation.perform_simulation.
+    :param token_labels: token labels, e.g. ['Boot', 'USDC']
+    :param initial_token_amounts: initial amounts of tokens
+    :param amplification: customswap amplification factors [A1, A2], the stableswap pool uses A1
+    :param promoted_token_label: customswap promoted token, by default the first token
+    :param fee_ratio: fee ratio of the pools
+    :return: dictionary of pricing method -> pool
+    """
+    if amplification is None:
+        amplification = [85, 0.0001]
+    if promoted_token_label is None:
+        promoted_token_label = token_labels[0]
+
+    return {'uniswap': LiquidityPool(token_labels, initial_token_amounts, fee_ratio=fee_ratio,
+                                     pricing_method='uniswap'),
+            'stableswap': LiquidityPool(token_labels, initial_token_amounts, fee_ratio=fee_ratio,
+                                        pricing_method='stableswap', amplification=amplification[0]),
+            'customswap': LiquidityPool(token_labels, initial_token_amounts, fee_ratio=fee_ratio,
+                                        pricing_method='customswap', amplification=amplification,
+                                        promoted_token_label=promoted_token_label)}
+
+
+def replay_dtype(n_pools, n_tokens):
+    # record of the pools after one replayed swap, each field has one value per pool
+    return np.dtype([('timestamp', np.float64), ('price', np.float64, (n_pools,)),
+                     ('slippage', np.float64, (n_pools,)), ('received_amount', np.float64, (n_pools,)),
+                     ('amplification', np.float64, (n_pools,)), ('token_amounts', np.float64, (n_pools, n_tokens))])
+
+
+def replay_swaps(pools, chunks, base_token_label, quote_token_label, amount_scale=1):
+    """
+    Replay a swap log through several pools side by side, one chunk at a time, so that memory use does not depend
+    on the length of the log.
+    :param pools: dictionary of name -> LiquidityPool, e.g. from make_replay_pools. The pools are modified.
+    :param chunks: iterable of dictionaries of column name -> array, e.g. from read_swap_log_csv
+    :param base_token_label: token whose price is recorded, e.g. 'Boot'
+    :param quote_token_label: token the price is expressed in, e.g. 'USDC'
+    :param amount_scale: factor applied to the logged payment amounts, e.g. to replay a log of a larger pool
+    :return: generator of structured arrays of replay_dtype, one per chunk, with the spot price of the base token,
+             the slippage (see LiquidityPool.get_price_slippage), received amount, amplification factor and token
+             amounts of each pool after each swap. Pools are in the order of the pools dictionary.
+    """
+    pools = list(pools.values())
+    base_token_index = pools[0].get_token_index(base_token_label)
+    quote_token_index = pools[0].get_token_index(quote_token_label)
+
+    # spot price of the base token in each pool, carried from one swap to the next
+    prices = [pool.get_price_by_index(quote_token_index, base_token_index) for pool in pools]
+
+    for chunk in chunks:
+        n_swaps = len(chunk['payment_token_amount'])
+        records = np.zeros(n_swaps, dtype=replay_dtype(len(pools), len(pools[0].token_labels)))
+        if 'timestamp' in chunk:
+            records['timestamp'] = chunk['timestamp']
+
+        payment_token_indices = chunk['payment_token'].tolist()
+        requested_token_indices = chunk['requested_token'].tolist()
+        payment_token_amounts = (np.asarray(chunk['payment_token_amount'], dtype=np.float64) * amount_scale).tolist()
+        slippages, received_amounts, pool_prices, amplifications, token_amounts = \
+            [records[field] for field in ('slippage', 'received_amount', 'price', 'amplification', 'token_amounts')]
+
+        for p, pool in enumerate(pools):
+            price = prices[p]
+            for i in range(n_swaps):
+                payment_token_index = payment_token_indices[i]
+                requested_token_index = requested_token_indices[i]
+                payment_token_amount = payment_token_amounts[i]
+
+                # price of the requested token in payment token before the swap
+                if payment_token_index == quote_token_index and requested_token_index == base_token_index:
+                    price_before_exchange = price
+                elif payment_token_index == base_token_index and requested_token_index == quote_token_index:
+                    price_before_exchange = 1 / price
+                else:
+                    price_before_exchange = pool.get_price_by_index(payment_token_index, requested_token_index)
+
+                received_amount = pool.exchange_by_index(payment_token_index, requested_token_index,
+                                                         payment_token_amount)
+                price = pool.get_price_by_index(quote_token_index, base_token_index)
+
+                slippages[i, p] = (payment_token_amount / received_amount - price_before_exchange) \
+                    / price_before_exchange
+                received_amounts[i, p] = received_amount
+                pool_prices[i, p] = price
+                amplifications[i, p] = pool.get_last_amplification()
+                token_amounts[i, p] = pool.get_token_amounts()
+            prices[p] = price
+
+        yield records
+
+
+def write_replay(path, records_chunks, pool_names):
+    """
+    Write replayed swaps to a binary file chunk by chunk, with a JSON metadata file next to it.
+    :param path: output file, the metadata is written to path + '.json'
+    :param records_chunks: iterable of structured arrays, e.g. from replay_swaps
+    :param pool_names: names of the pools, in the order of the records
+    :return: number of records written
+    """
+    n_records = 0
+    dtype = None
+    with open(path, 'wb') as f:
+        for records in records_chunks:
+            records.tofile(f)
+            n_records += len(records)
+            dtype = records.dtype
+
+    with open(path + '.json', 'w') as f:
+        json.dump({'pools': list(pool_names), 'n_records': n_records,
+                   'dtype': np.lib.format.dtype_to_descr(dtype) if dtype is not None else None}, f)
+
+    return n_records
+
+
+def load_replay(path):
+    """
+    Load replayed swaps written by write_replay, memory-mapped.
+    :param path: file written by write_replay
+    :return: pool names, structured array of the records
+    """
+    with open(path + '.json') as f:
+        metadata = json.load(f)
+
+    if metadata['n_records'] == 0:
+        return metadata['pools'], np.zeros(0)
+
+    dtype = np.lib.format.descr_to_dtype([tuple(field) for field in metadata['dtype']])
+    return metadata['pools'], np.memmap(path, dtype=dtype, mode='r', shape=(metadata['n_records'],))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a swap log through Uniswap, Stableswap and Customswap pools.')
+    parser.add_argument('swap_log', help='CSV file, or directory of binary columns written by --convert')
+    parser.add_argument('--output', help='binary file for the replayed swaps')
+    parser.add_argument('--convert', help='only convert the CSV swap log to binary columns in this directory')
+    parser.add_argument('--tokens', nargs='+', default=['Boot', 'USDC'], help='token labels, base token first')
+    parser.add_argument('--amounts', nargs='+', type=float, default=[50000, 50000],
+                        help='initial token amounts of the pools')
+    parser.add_argument('--a1', type=float, default=85, help='customswap A1, also used by the stableswap pool')
+    parser.add_argument('--a2', type=float, default=0.0001, help='customswap A2')
+    parser.add_argument('--fee-ratio', type=float, default=0, help='fee ratio of the pools')
+    parser.add_argument('--amount-scale', type=float, default=1, help='factor applied to the logged amounts')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='swaps per chunk')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.swap_log):
+        chunks = read_swap_log_columns(args.swap_log, chunk_size=args.chunk_size)
+    else:
+        chunks = read_swap_log_csv(args.swap_log, args.tokens, chunk_size=args.chunk_size)
+
+    if args.convert:
+        write_swap_log_columns(args.convert, chunks)
+        return
+
+    pools = make_replay_pools(args.tokens, args.amounts, amplification=[args.a1, args.a2], fee_ratio=args.fee_ratio)
+    records_chunks = replay_swaps(pools, chunks, args.tokens[0], args.tokens[1], amount_scale=args.amount_scale)
+
+    if args.output:
+        n_records = write_replay(args.output, records_chunks, pools)
+        print('replayed %d swaps to %s' % (n_records, args.output))
+    else:
+        for records in records_chunks:
+            for record in records:
+                print(record['timestamp'], ' '.join('%s=%.6g' % (name, price)
+                                                    for name, price in zip(pools, record['price'])))
+
+
+if __name__ == '__main__':
+    main()
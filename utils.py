@@ -1,4 +1,95 @@
+import logging
+import math
+
+import numpy as np
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import jit_kernels
+
 D_EQUALITY_PRECISION = 1e-6
+Y_EQUALITY_PRECISION = 1
+
+# solves that do not converge are counted by the active SolverTelemetry, and logged here when there is none
+logger = logging.getLogger(__name__)
+
+# SolverTelemetry collecting convergence statistics of curve_get_D and curve_get_y, None when disabled. A context
+# variable, so that threads (e.g. background sweep jobs and request threads) each have their own collector.
+_solver_telemetry = ContextVar('solver_telemetry', default=None)
+
+
+def get_solver_telemetry():
+    # the SolverTelemetry collecting in the current thread or context, None if there is none
+    return _solver_telemetry.get()
+
+
+class SolverTelemetry:
+    # Convergence statistics of the Newton solvers, keyed by (solver name, pricing method, amplification factor).
+
+    def __init__(self):
+        self.pricing_method = None  # tag for the following solves, set by LiquidityPool
+        # the compiled solvers report no statistics, so they are bypassed while collecting
+        self.jit_bypassed = jit_kernels.enabled
+        self.calls = Counter()
+        self.iterations = defaultdict(Counter)  # histogram of the number of iterations
+        self.non_converged = Counter()
+        self.max_residuals = {}  # largest change of the solution in the last iteration
+
+    def record(self, solver, amp, iterations, residual, converged):
+        key = (solver, self.pricing_method, amp)
+        self.calls[key] += 1
+        self.iterations[key][iterations] += 1
+        if not converged:
+            self.non_converged[key] += 1
+        self.max_residuals[key] = max(self.max_residuals.get(key, 0.0), float(residual))
+
+    def record_batch(self, solver, amps, iterations, residuals, converged):
+        # one record per pool state of a batched solve
+        for amp, n_iterations, residual, state_converged in zip(amps, iterations, residuals, converged):
+            self.record(solver, float(amp), int(n_iterations), residual, bool(state_converged))
+
+    def summary(self):
+        """
+        Summarize the collected statistics.
+        :return: list of dictionaries, one per (solver, pricing method, amplification factor)
+        """
+        summary = []
+        for key, calls in self.calls.items():
+            solver, pricing_method, amp = key
+            histogram = self.iterations[key]
+            summary.append({'solver': solver, 'pricing_method': pricing_method, 'amplification': amp,
+                            'calls': calls,
+                            'mean_iterations': sum(n * count for n, count in histogram.items()) / calls,
+                            'max_iterations': max(histogram),
+                            'iteration_histogram': dict(sorted(histogram.items())),
+                            'non_converged': self.non_converged[key],
+                            'max_residual': self.max_residuals[key],
+                            'jit_bypassed': self.jit_bypassed})
+        return summary
+
+
+@contextmanager
+def collect_solver_telemetry():
+    """
+    Collect convergence statistics of curve_get_D, curve_get_y and curve_get_D_batch within a with block, e.g.
+        with collect_solver_telemetry() as telemetry:
+            perform_simulation()
+        print(telemetry.summary())
+    Only solves in the current thread (or context) are collected. While collecting, the Python solvers are used
+    instead of the compiled jit_kernels ones, which report no statistics; summary entries record this as
+    'jit_bypassed'.
+    """
+    token = _solver_telemetry.set(SolverTelemetry())
+    try:
+        yield _solver_telemetry.get()
+    finally:
+        _solver_telemetry.reset(token)
+
+
+def _as_list(x):
+    # token amounts as a list of Python floats, which are faster than NumPy for the few coins of a pool
+    return x.tolist() if isinstance(x, np.ndarray) else [float(_x) for _x in x]
 
 
 def curve_get_dy(payment_token_index, requested_token_index, payment_token_amount, token_amounts_before_payment,
@@ -26,7 +117,7 @@ def curve_get_dy(payment_token_index, requested_token_index, payment_token_amoun
 
 
 def curve_get_y(payment_token_index, requested_token_index, token_amounts_after_payment,
-                token_amounts_before_payment, amp) -> float:
+                token_amounts_before_payment, amp, D=None) -> float:
     """
     calculates how much of the requested token should be in the pool after a payment which results in the total amount
     of the payment token to become x.
@@ -35,6 +126,7 @@ def curve_get_y(payment_token_index, requested_token_index, token_amounts_after_
     :param token_amounts_after_payment: total amount of payment token in the pool after payment
     :param token_amounts_before_payment: amount of token in the pool before payment.
     :param amp: the amplification factor
+    :param D: optional precomputed quantity D of the pool before payment, computed with the same amplification factor
     :return: total amount of the requested token in the pool after payment
     """
     # x in the input is converted to the same price/precision
@@ -45,24 +137,25 @@ def curve_get_y(payment_token_index, requested_token_index, token_amounts_after_
     # should be unreachable, but good for safety
     assert payment_token_index >= 0
     assert payment_token_index < N_COINS
-    D = curve_get_D(token_amounts_before_payment, amp)
-    c = D
-    S_ = 0
+    if D is None:
+        D = curve_get_D(token_amounts_before_payment, amp)
+
+    solver_telemetry = _solver_telemetry.get()
+    if jit_kernels.enabled and solver_telemetry is None:
+        return jit_kernels.curve_get_y(payment_token_index, requested_token_index, token_amounts_after_payment,
+                                       token_amounts_before_payment, amp, D, Y_EQUALITY_PRECISION)
+
     Ann = amp * N_COINS
-    _x = 0
-    _i = 0
-
-    for _i in range(N_COINS) :
-        if _i == payment_token_index:
-            _x = token_amounts_after_payment
-        elif _i != requested_token_index:
-            _x = token_amounts_before_payment[_i]
-        else:
-            continue
-        S_ += _x
-        c = c * D / (_x * N_COINS)
 
+    # amounts of all coins but the requested one, with the payment made
+    _x = _as_list(token_amounts_before_payment)
+    _x[payment_token_index] = token_amounts_after_payment
+    del _x[requested_token_index]
 
+    # c = D ** n / (n ** (n - 1) * prod(_x)), evaluated as D * (D / G) ** (n - 1) like D_P in curve_get_D
+    S_ = sum(_x)
+    G = N_COINS * math.prod(_x) ** (1 / (N_COINS - 1))
+    c = D * (D / G) ** (N_COINS - 1)
     c = c * D / (Ann * N_COINS)
     b = S_ + D / Ann  # - D
     y_prev = 0
@@ -72,11 +165,15 @@ def curve_get_y(payment_token_index, requested_token_index, token_amounts_after_
         y = (y * y + c) / (2 * y + b - D)
         # Equality with the precision of 1
         if y > y_prev:
-            if y - y_prev <= 1:
+            if y - y_prev <= Y_EQUALITY_PRECISION:
                 break
         else:
-            if y_prev - y <= 1:
+            if y_prev - y <= Y_EQUALITY_PRECISION:
                 break
+
+    if solver_telemetry is not None:
+        solver_telemetry.record('curve_get_y', amp, _i + 1, abs(y - y_prev), abs(y - y_prev) <= Y_EQUALITY_PRECISION)
+
     return y
 
 
@@ -88,25 +185,237 @@ def curve_get_D(x, A):
     :return: quantity D as noted in the StableSwap white paper
     """
 
+    solver_telemetry = _solver_telemetry.get()
+    if jit_kernels.enabled and solver_telemetry is None:
+        D, residual = jit_kernels.curve_get_D(x, A, D_EQUALITY_PRECISION)
+        if residual > D_EQUALITY_PRECISION:
+            logger.warning('curve_get_D did not converge for A=%g, D=%r', A, D)
+        return D
+
+    x = _as_list(x)
+    n_coins = len(x)
     S = sum(x)
 
+    # D_P = D ** (n + 1) / (n ** n * prod(x)) is evaluated as D * (D / G) ** n with G = n * prod(x) ** (1 / n), so
+    # the product over the coins is taken once instead of in every iteration
+    G = n_coins * math.prod(x) ** (1 / n_coins)
+
     D = S
-    Ann = A * len(x)
+    Ann = A * n_coins
     for c in range(0, 254):
-        D_P = D
-
-        for i in range(len(x)):
-            D_P = D_P * D / (x[i] * len(x))
+        D_P = D * (D / G) ** n_coins
 
         Dprev = D
-        D = (Ann * S + D_P * len(x)) * D / ((Ann - 1) * D + (len(x) + 1) * D_P)
+        D = (Ann * S + D_P * n_coins) * D / ((Ann - 1) * D + (n_coins + 1) * D_P)
         if D >= Dprev:
             if D - Dprev <= D_EQUALITY_PRECISION:
                 break
             elif Dprev - D <= D_EQUALITY_PRECISION:
                 break
 
-    if abs(D - Dprev) > D_EQUALITY_PRECISION:
-        print('Failed to find the right D for value', D)
+    if solver_telemetry is not None:
+        solver_telemetry.record('curve_get_D', A, c + 1, abs(D - Dprev), abs(D - Dprev) <= D_EQUALITY_PRECISION)
+    elif abs(D - Dprev) > D_EQUALITY_PRECISION:
+        logger.warning('curve_get_D did not converge for A=%g, D=%r', A, D)
+
+    return D
+
+
+def uniswap_get_y(payment_token_index, requested_token_index, token_amounts_after_payment,
+                  token_amounts_before_payment) -> float:
+    """
+    calculates how much of the requested token should be in a constant-product (Uniswap) pool after a payment which
+    results in the total amount of the payment token to become x. Solved in closed form from x * y = k.
+    :param payment_token_index: the index of the token used as payment
+    :param requested_token_index: the index of the token to be returned
+    :param token_amounts_after_payment: total amount of payment token in the pool after payment
+    :param token_amounts_before_payment: amount of token in the pool before payment.
+    :return: total amount of the requested token in the pool after payment
+    """
+    assert payment_token_index != requested_token_index  # dev: same coin
+
+    return token_amounts_before_payment[requested_token_index] * token_amounts_before_payment[payment_token_index] \
+        / token_amounts_after_payment
+
+
+def uniswap_get_D(x):
+    """
+    Calculate quantity D of a constant-product (Uniswap) pool, which is the limit of the StableSwap D when the
+    amplification factor goes to zero: D = n * (x_1 * ... * x_n) ** (1 / n).
+    :param x: amounts of tokens in the pool
+    :return: quantity D as noted in the StableSwap white paper
+    """
+    x = _as_list(x)
+    n_coins = len(x)
+    return n_coins * math.prod(x) ** (1 / n_coins)
+
+def curve_get_spot_price(payment_token_index, requested_token_index, token_amounts, amp, D=None) -> float:
+    """
+    calculates the marginal price of the requested token in payment token, by implicit differentiation of the
+    StableSwap invariant Ann * (S - D) + D - D ** (n + 1) / (n ** n * prod(x)) = 0 at constant D.
+    :param payment_token_index: the index of the token used as payment
+    :param requested_token_index: the index of the token to be returned
+    :param token_amounts: amounts of tokens in the pool
+    :param amp: the amplification factor
+    :param D: optional precomputed quantity D of the pool, computed with the same amplification factor
+    :return: how much of payment token is needed per unit of requested token, for an infinitesimal trade
+    """
+    N_COINS = len(token_amounts)
+    if D is None:
+        D = curve_get_D(token_amounts, amp)
+
+    D_P = D * (D / uniswap_get_D(token_amounts)) ** N_COINS
+    Ann = amp * N_COINS
+
+    # dx_requested / dx_payment = - dF/dx_payment / dF/dx_requested, with dF/dx_k = Ann + D_P / x_k
+    return (Ann + D_P / token_amounts[requested_token_index]) / (Ann + D_P / token_amounts[payment_token_index])
+
+
+def uniswap_get_spot_price(payment_token_index, requested_token_index, token_amounts) -> float:
+    """
+    calculates the marginal price of the requested token in payment token for a constant-product (Uniswap) pool.
+    :param payment_token_index: the index of the token used as payment
+    :param requested_token_index: the index of the token to be returned
+    :param token_amounts: amounts of tokens in the pool
+    :return: how much of payment token is needed per unit of requested token, for an infinitesimal trade
+    """
+    return token_amounts[payment_token_index] / token_amounts[requested_token_index]
+
+def curve_get_spot_price_batch(payment_token_index, requested_token_index, token_amounts, amp, D=None):
+    """
+    Vectorized version of curve_get_spot_price computing the marginal price for many pool states at once.
+    :param payment_token_index: the index of the token used as payment
+    :param requested_token_index: the index of the token to be returned
+    :param token_amounts: array of shape (n_states, n_coins) with the amounts of tokens in each pool
+    :param amp: the amplification factor, scalar or array of shape (n_states,)
+    :param D: optional precomputed quantity D of each pool state, shape (n_states,)
+    :return: array of shape (n_states,) with how much of payment token is needed per unit of requested token
+    """
+    xp = np.atleast_2d(np.asarray(token_amounts, dtype=np.float64))
+    N_COINS = xp.shape[1]
+    if D is None:
+        D = curve_get_D_batch(xp, amp)
+
+    G = N_COINS * np.prod(xp, axis=1) ** (1 / N_COINS)  # see curve_get_D
+    D_P = D * (D / G) ** N_COINS
+    Ann = np.asarray(amp, dtype=np.float64) * N_COINS
+
+    return (Ann + D_P / xp[:, requested_token_index]) / (Ann + D_P / xp[:, payment_token_index])
+
+
+def curve_get_dy_batch(payment_token_index, requested_token_index, payment_token_amounts,
+                       token_amounts_before_payment, amp, fee_percent):
+    """
+    Vectorized version of curve_get_dy computing the returned amount for many pool states at once.
+    :param payment_token_index: the index of the token used as payment
+    :param requested_token_index: the index of the token to be returned
+    :param payment_token_amounts: amounts of payment token, scalar or array of shape (n_states,)
+    :param token_amounts_before_payment: array of shape (n_states, n_coins) with the amounts of tokens in each pool
+    :param amp: the amplification factor, scalar or array of shape (n_states,)
+    :param fee_percent: Fee percent, e.g. 0.006
+    :return: array of shape (n_states,) with the change (dy) in the amount of the requested token
+    """
+
+    token_amounts_before_payment = np.atleast_2d(np.asarray(token_amounts_before_payment, dtype=np.float64))
+    y = curve_get_y_batch(payment_token_index, requested_token_index,
+                          token_amounts_before_payment[:, payment_token_index] + payment_token_amounts,
+                          token_amounts_before_payment, amp)
+
+    dy = token_amounts_before_payment[:, requested_token_index] - y
+    fee = dy * fee_percent
+    dy = dy - fee
+    return dy
+
+
+def curve_get_y_batch(payment_token_index, requested_token_index, token_amounts_after_payment,
+                      token_amounts_before_payment, amp, D=None):
+    """
+    Vectorized version of curve_get_y solving many pool states at once. Newton iterations stop separately for
+    each pool state once it has converged.
+    :param payment_token_index: the index of the token used as payment
+    :param requested_token_index: the index of the token to be returned
+    :param token_amounts_after_payment: total amounts of payment token in each pool after payment, shape (n_states,)
+    :param token_amounts_before_payment: array of shape (n_states, n_coins) with token amounts before payment
+    :param amp: the amplification factor, scalar or array of shape (n_states,)
+    :param D: optional precomputed quantity D of each pool state, shape (n_states,)
+    :return: array of shape (n_states,) with total amounts of the requested token in each pool after payment
+    """
+    xp = np.atleast_2d(np.asarray(token_amounts_before_payment, dtype=np.float64))
+    n_states, N_COINS = xp.shape
+    assert payment_token_index != requested_token_index  # dev: same coin
+    assert 0 <= requested_token_index < N_COINS
+    assert 0 <= payment_token_index < N_COINS
+
+    amp = np.broadcast_to(np.asarray(amp, dtype=np.float64), (n_states,))
+    if D is None:
+        D = curve_get_D_batch(xp, amp)
+    else:
+        D = np.broadcast_to(np.asarray(D, dtype=np.float64), (n_states,))
+
+    xp = xp.copy()
+    xp[:, payment_token_index] = token_amounts_after_payment
+    others = np.delete(xp, requested_token_index, axis=1)
+
+    Ann = amp * N_COINS
+    S_ = others.sum(axis=1)
+    c = D * np.prod(D[:, None] / (others * N_COINS), axis=1)
+    c = c * D / (Ann * N_COINS)
+    b = S_ + D / Ann  # - D
+
+    y = D.copy()
+    active = np.arange(n_states)
+    for _i in range(0, 254):
+        y_prev = y[active]
+        y_new = (y_prev * y_prev + c[active]) / (2 * y_prev + b[active] - D[active])
+        y[active] = y_new
+        # Equality with the precision of 1
+        active = active[np.abs(y_new - y_prev) > Y_EQUALITY_PRECISION]
+        if active.size == 0:
+            break
+    return y
+
+
+def curve_get_D_batch(x, A):
+    """
+    Vectorized version of curve_get_D solving many pool states at once. Newton iterations stop separately for
+    each pool state once it has converged.
+    :param x: array of shape (n_states, n_coins) with the amounts of tokens in each pool
+    :param A: amplification factor, scalar or array of shape (n_states,)
+    :return: array of shape (n_states,) with quantity D of each pool state
+    """
+
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    n_states, n_coins = x.shape
+
+    S = x.sum(axis=1)
+    G = n_coins * np.prod(x, axis=1) ** (1 / n_coins)  # see curve_get_D
+
+    solver_telemetry = _solver_telemetry.get()
+    if solver_telemetry is not None:
+        iterations = np.full(n_states, 254)
+        residuals = np.zeros(n_states)
+
+    D = S.copy()
+    Ann = np.broadcast_to(np.asarray(A, dtype=np.float64), (n_states,)) * n_coins
+    active = np.arange(n_states)
+    for c in range(0, 254):
+        Dprev = D[active]
+        D_P = Dprev * (Dprev / G[active]) ** n_coins
+        D_new = (Ann[active] * S[active] + D_P * n_coins) * Dprev / \
+                ((Ann[active] - 1) * Dprev + (n_coins + 1) * D_P)
+        D[active] = D_new
+        residual = np.abs(D_new - Dprev)
+        if solver_telemetry is not None:
+            residuals[active] = residual
+            iterations[active] = c + 1
+        active = active[residual > D_EQUALITY_PRECISION]
+        if active.size == 0:
+            break
+
+    if solver_telemetry is not None:
+        solver_telemetry.record_batch('curve_get_D_batch', Ann / n_coins, iterations, residuals,
+                                      residuals <= D_EQUALITY_PRECISION)
+    elif active.size > 0:
+        logger.warning('curve_get_D_batch did not converge for %d pool states', active.size)
 
-    return D
\ No newline at end of file
+    return D